@@ -0,0 +1,262 @@
+"""Incremental summaries of the collected annotations.
+
+Each pass reads only what was appended since the previous one: the state file
+keeps a byte offset per response file (or the last row ID of the SQLite
+annotation table) together with the running per-qid counts, and both are saved
+in one atomic write, so an interrupted pass is simply repeated. Only complete
+lines are consumed, so files still being written by the app are safe to read.
+
+    python aggregate_responses.py                 # one pass
+    python aggregate_responses.py --watch 30      # keep updating during a study
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from collections import Counter
+
+from atomic_file import atomic_write
+from annotation_sink import RESPONSE_DIR
+from jsonl_index import JsonlIndex
+
+STATE_FILE = 'responses_aggregate_state.json'  # Watermarks and running counts
+SUMMARY_FILE = 'responses_summary.json'
+DATASET_FILE = 'data_with_gpt.jsonl'  # Source of the gpt_answer each qid is compared with
+DB_BATCH = 1000  # annotation rows read per query from the SQLite backend
+RATINGS = ('not_aligned', 'slightly_aligned', 'moderately_aligned', 'aligned_well', 'completely_aligned')
+RATING_LEVEL = {  # Alignment ratings on the scale of GPT's confidence
+    'not_aligned': 'low', 'slightly_aligned': 'low', 'moderately_aligned': 'medium',
+    'aligned_well': 'high', 'completely_aligned': 'high',
+}
+
+def new_state():
+    return {'files': {}, 'db_last_id': 0, 'annotations': 0, 'duplicates': 0, 'qids': {}}
+
+def load_state(path):
+    if not os.path.exists(path):
+        return new_state()
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def write_json(path, payload):
+    with atomic_write(path) as file:
+        json.dump(payload, file, indent=1)
+
+def add_annotation(state, record):
+    """Fold one annotation into the per-qid counts; returns False for a repeated (annotator, qid)"""
+    qid = str(record.get('qid'))
+    summary = state['qids'].setdefault(qid, {
+        'annotators': [], 'background_color': {}, 'text_elements': {}, 'overall': {}, 'image_ranks': {},
+    })
+    annotator = record.get('prolific_id') or record.get('session_id')
+    if annotator in summary['annotators']:
+        # A resubmitted page (e.g. after going back); the first answer counts
+        state['duplicates'] += 1
+        return False
+    summary['annotators'].append(annotator)
+    state['annotations'] += 1
+
+    scores = []
+    rating = record.get('background_color')
+    if rating in RATINGS:
+        summary['background_color'][rating] = summary['background_color'].get(rating, 0) + 1
+        scores.append(RATINGS.index(rating) + 1)
+    for element, rating in (record.get('text_elements') or {}).items():
+        if rating in RATINGS:
+            counts = summary['text_elements'].setdefault(element, {})
+            counts[rating] = counts.get(rating, 0) + 1
+            scores.append(RATINGS.index(rating) + 1)
+    if scores:
+        overall = RATINGS[round(sum(scores) / len(scores)) - 1]
+        summary['overall'][overall] = summary['overall'].get(overall, 0) + 1
+
+    image_ranks = record.get('image_ranks') or {}
+    # Before the rank fields were fixed the form never sent ranks for the first image set,
+    # and whatever ranks were read belonged to other sets, so such records carry no ranks
+    if any(image_ranks.get('rank_image_1', {}).values()):
+        for set_key, ranks in image_ranks.items():
+            values = [int(ranks[key]) if str(ranks.get(key) or '').isdigit() else None
+                      for key in sorted(ranks, key=lambda key: int(key.rsplit('_', 1)[1]))]
+            entry = summary['image_ranks'].setdefault(set_key, {'sum': [], 'count': [], 'top': []})
+            for vector in entry.values():
+                vector.extend([0] * (len(values) - len(vector)))
+            for i, value in enumerate(values):
+                if value is not None:
+                    entry['sum'][i] += value
+                    entry['count'][i] += 1
+                    entry['top'][i] += value == 1
+    return True
+
+def read_new_lines(path, offset):
+    """Complete lines appended after `offset`, and the offset just past the last of them"""
+    records = []
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                break  # Still being written
+            offset += len(line)
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Skipping malformed line in {path} at byte {offset - len(line)}")
+    return records, offset
+
+def ingest_directory(state, directory):
+    """Fold in everything appended to the response files since the last pass; returns (annotations, files)"""
+    added, touched = 0, 0
+    for path in sorted(glob.glob(os.path.join(directory, '*.jsonl'))):
+        name = os.path.basename(path)
+        offset = state['files'].get(name, 0)
+        size = os.path.getsize(path)
+        if size < offset:
+            print(f"{path} is shorter than its watermark ({size} < {offset}); it was not appended to, skipping")
+            continue
+        if size == offset:
+            continue
+        records, state['files'][name] = read_new_lines(path, offset)
+        added += sum(add_annotation(state, record) for record in records)
+        touched += 1
+    return added, touched
+
+def ingest_database(state, db_path):
+    """Fold in the rows of the SQLite `annotations` table added since the last pass"""
+    import sqlite3
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    added = 0
+    try:
+        while True:
+            rows = conn.execute('SELECT id, data FROM annotations WHERE id > ? ORDER BY id LIMIT ?',
+                                (state['db_last_id'], DB_BATCH)).fetchall()
+            if not rows:
+                break
+            for row_id, data in rows:
+                added += add_annotation(state, json.loads(data))
+                state['db_last_id'] = row_id
+    finally:
+        conn.close()
+    return added
+
+def fleiss_kappa(items):
+    """Fleiss' kappa over items given as category -> count, allowing a different number of raters per item"""
+    agreements, totals = [], Counter()
+    for counts in items:
+        n = sum(counts.values())
+        if n < 2:
+            continue
+        agreements.append((sum(c * c for c in counts.values()) - n) / (n * (n - 1)))
+        totals.update(counts)
+    if not agreements:
+        return {'items': 0, 'observed': None, 'kappa': None}
+    observed = sum(agreements) / len(agreements)
+    grand = sum(totals.values())
+    expected = sum((count / grand) ** 2 for count in totals.values())
+    kappa = (observed - expected) / (1 - expected) if expected < 1 else None
+    return {'items': len(agreements), 'observed': round(observed, 4), 'kappa': round(kappa, 4) if kappa is not None else None}
+
+def gpt_agreement(counts, confidence):
+    """Share of ratings whose level matches GPT's confidence; returns (matches, total)"""
+    if confidence not in ('low', 'medium', 'high'):
+        return 0, 0
+    return (sum(count for rating, count in counts.items() if RATING_LEVEL[rating] == confidence),
+            sum(counts.values()))
+
+def mean_score(counts):
+    total = sum(counts.values())
+    return round(sum((RATINGS.index(r) + 1) * c for r, c in counts.items()) / total, 3) if total else None
+
+def summarize(state, dataset=None):
+    """Per-qid summaries plus agreement between annotators and with gpt_answer"""
+    qids, matches = {}, Counter()
+    background_items, text_items, top_image_items = [], [], []
+    for qid, summary in state['qids'].items():
+        gpt_answer = {}
+        if dataset is not None and qid.lstrip('-').isdigit():
+            gpt_answer = (dataset.get(int(qid)) or {}).get('gpt_answer') or {}
+        agreement = {}
+        for field, counts, confidence in (
+                ('background_color', summary['background_color'], (gpt_answer.get('background_color') or {}).get('confidence')),
+                ('text_elements', sum((Counter(c) for c in summary['text_elements'].values()), Counter()),
+                 (gpt_answer.get('text_elements') or {}).get('confidence')),
+                ('overall', summary['overall'], gpt_answer.get('overall_confidence'))):
+            matched, total = gpt_agreement(counts, confidence)
+            matches[field, 'matched'] += matched
+            matches[field, 'total'] += total
+            agreement[field] = round(matched / total, 4) if total else None
+
+        background_items.append(summary['background_color'])
+        text_items.extend(summary['text_elements'].values())
+        mean_ranks = {}
+        for set_key, entry in summary['image_ranks'].items():
+            mean_ranks[set_key] = [round(s / c, 3) if c else None for s, c in zip(entry['sum'], entry['count'])]
+            top_image_items.append({str(i): count for i, count in enumerate(entry['top']) if count})
+        qids[qid] = {
+            'annotations': len(summary['annotators']),
+            'background_color': summary['background_color'],
+            'background_color_mean': mean_score(summary['background_color']),
+            'text_elements': summary['text_elements'],
+            'text_elements_mean': {element: mean_score(counts) for element, counts in summary['text_elements'].items()},
+            'mean_image_ranks': mean_ranks,
+            'gpt_agreement': agreement,
+        }
+
+    return {
+        'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'annotations': state['annotations'],
+        'duplicates_ignored': state['duplicates'],
+        'qids_annotated': len(qids),
+        'inter_annotator': {
+            'background_color': fleiss_kappa(background_items),
+            'text_elements': fleiss_kappa(text_items),
+            'top_ranked_image': fleiss_kappa(top_image_items),
+        },
+        'gpt_agreement': {field: round(matches[field, 'matched'] / matches[field, 'total'], 4) if matches[field, 'total'] else None
+                          for field in ('background_color', 'text_elements', 'overall')},
+        'qids': qids,
+    }
+
+def run_pass(args, dataset):
+    state = load_state(args.state_file)
+    added, touched = ingest_directory(state, args.responses_dir) if os.path.isdir(args.responses_dir) else (0, 0)
+    if args.db:
+        added += ingest_database(state, args.db)
+    summary = summarize(state, dataset)
+    write_json(args.summary_file, summary)
+    write_json(args.state_file, state)
+    agreement = summary['inter_annotator']['background_color']
+    print(f"+{added} annotations from {touched} files; {summary['annotations']} annotations over "
+          f"{summary['qids_annotated']} qids; background color kappa {agreement['kappa']}, "
+          f"GPT agreement {summary['gpt_agreement']['overall']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Incrementally aggregate collected annotations')
+    parser.add_argument('--responses-dir', default=RESPONSE_DIR, help='Directory of JSONL response files')
+    parser.add_argument('--db', default=None, help='Also read the annotations table of this SQLite state DB')
+    parser.add_argument('--dataset', default=DATASET_FILE, help='Dataset JSONL with the gpt_answer of each qid')
+    parser.add_argument('--state-file', default=STATE_FILE, help='Watermarks and running counts between passes')
+    parser.add_argument('--summary-file', default=SUMMARY_FILE, help='Where the summary JSON is written')
+    parser.add_argument('--reset', action='store_true', help='Forget the watermarks and aggregate everything again')
+    parser.add_argument('--watch', type=float, default=0, help='Repeat every this many seconds')
+    args = parser.parse_args()
+
+    if args.reset and os.path.exists(args.state_file):
+        os.remove(args.state_file)
+    dataset = JsonlIndex(args.dataset, cache_size=0) if os.path.exists(args.dataset) else None
+    if dataset is None:
+        print(f"{args.dataset} not found; agreement with gpt_answer is not computed")
+    try:
+        while True:
+            run_pass(args, dataset)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dataset is not None:
+            dataset.close()
+
+if __name__ == '__main__':
+    main()
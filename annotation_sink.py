@@ -0,0 +1,193 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+RESPONSE_DIR = 'responses'  # Directory to store responses
+FLUSH_INTERVAL = 1.0  # seconds the writer waits to collect a batch
+MAX_BATCH = 200  # annotations written per batch at most
+MAX_OPEN_FILES = 64  # per-annotator files kept open by the JSONL sink
+
+log = logging.getLogger('annotation.sink')  # Goes through the app's handler once configure_logging('annotation') ran
+
+class AnnotationSink:
+    """Queues annotations and writes them in batches from a background thread.
+
+    Subclasses implement write_batch. Pending annotations are flushed by close(),
+    which is registered to run at interpreter shutdown. `on_saved`, if given, is
+    called from the writer thread with the seconds each annotation of a batch
+    spent between write() and being on disk, or with the exception if the batch failed.
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH, on_saved=None):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.on_saved = on_saved
+        self.closed = False
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        if self.closed:
+            raise RuntimeError("Annotation sink is closed")
+        if self.pid != os.getpid():
+            # Threads do not survive a fork (e.g. gunicorn --preload), so each worker starts its own writer
+            self._start()
+        self.queue.put((record, time.monotonic()))
+
+    def flush(self):
+        """Block until everything written so far is on disk"""
+        if self.closed:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self.closed or self.pid != os.getpid():
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.close_backend()
+
+    def _run(self):
+        while True:
+            batch, waiters, stop = [], [], False
+            item = self.queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                if stop or waiters or len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.write_batch([record for record, _ in batch])
+                except Exception as e:
+                    log.error("Error writing %d annotations: %s", len(batch), e, exc_info=True)
+                    if self.on_saved:
+                        self.on_saved([], e)
+                else:
+                    if self.on_saved:
+                        now = time.monotonic()
+                        self.on_saved([now - queued_at for _, queued_at in batch], None)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    def write_batch(self, records):
+        raise NotImplementedError
+
+    def close_backend(self):
+        pass
+
+class JsonlAnnotationSink(AnnotationSink):
+    """Appends annotations to one JSONL file per annotator, or to `shards` shared files.
+
+    Each batch is a single O_APPEND write per file followed by one fsync, so
+    several worker processes can append to the same file without interleaving rows.
+    """
+    def __init__(self, directory=RESPONSE_DIR, shards=None, **kwargs):
+        self.directory = directory
+        self.shards = shards
+        self.files = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def file_name(self, record):
+        annotator_id = str(record.get('prolific_id') or 'unknown')
+        if self.shards:
+            return f"shard_{zlib.crc32(annotator_id.encode('utf-8')) % self.shards:03d}.jsonl"
+        return f"{re.sub(r'[^A-Za-z0-9_.-]', '_', annotator_id).lstrip('.') or 'unknown'}.jsonl"
+
+    def _fd(self, name):
+        if name in self.files:
+            self.files.move_to_end(name)
+            return self.files[name]
+        if len(self.files) >= MAX_OPEN_FILES:
+            os.close(self.files.popitem(last=False)[1])
+        fd = os.open(os.path.join(self.directory, name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.files[name] = fd
+        return fd
+
+    def write_batch(self, records):
+        lines = {}
+        for record in records:
+            lines.setdefault(self.file_name(record), []).append(json.dumps(record) + '\n')
+        for name, file_lines in lines.items():
+            fd = self._fd(name)
+            payload = ''.join(file_lines).encode('utf-8')
+            while payload:
+                payload = payload[os.write(fd, payload):]
+            os.fsync(fd)
+
+    def close_backend(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files.clear()
+
+def create_annotations_table(conn):
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS annotations ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT, prolific_id TEXT, session_id TEXT, qid INTEGER,'
+        ' created_at REAL NOT NULL, data TEXT NOT NULL)'
+    )
+
+def insert_annotations(conn, records):
+    """Insert annotation rows; the caller owns the transaction"""
+    now = time.time()
+    conn.executemany(
+        'INSERT INTO annotations (prolific_id, session_id, qid, created_at, data) VALUES (?, ?, ?, ?, ?)',
+        [(r.get('prolific_id'), r.get('session_id'), r.get('qid'), now, json.dumps(r)) for r in records]
+    )
+
+class SQLiteAnnotationSink(AnnotationSink):
+    """Inserts annotations into the `annotations` table of a SQLite database, one transaction per batch"""
+    def __init__(self, db, **kwargs):
+        self.db = db
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        conn = self.db.connect()
+        create_annotations_table(conn)
+        return conn
+
+    def write_batch(self, records):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            insert_annotations(conn, records)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+class MemoryAnnotationSink(AnnotationSink):
+    """Keeps annotations in a list, for tests and throwaway runs"""
+    def __init__(self, records=None, **kwargs):
+        self.records = records if records is not None else []
+        super().__init__(**kwargs)
+
+    def write_batch(self, records):
+        self.records.extend(json.loads(json.dumps(record)) for record in records)
@@ -1,117 +1,368 @@
-from flask import Flask, render_template, request, redirect, url_for
-import json
-import random
+from flask import Flask, Response, render_template, request, redirect, url_for, g, abort, send_file, jsonify, session as cookie_session
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from collections import OrderedDict
+import hashlib
+import threading
+from datetime import timedelta
+import secrets
+import shutil
 import uuid
 import os
 import time
 import argparse
+import logging
+from atomic_file import atomic_write
+from storage import open_storage, read_batch_counts, write_batch_counts, STATE_DB, MEMORY, SESSION_TTL, SNAPSHOT_META_KEY
+from annotation_sink import JsonlAnnotationSink, RESPONSE_DIR
+from dataset_snapshot import DatasetSnapshot, SnapshotMismatch, build_snapshot, snapshot_path_for
+from image_cache import ImageCache, IMAGE_CACHE_DIR, THUMB_WIDTHS, DEFAULT_THUMB_WIDTH, url_key
+from instrumentation import MetricsRegistry, METRICS_DIR, configure_logging
+import io
 
-random.seed(42)
 app = Flask(__name__)
 app.jinja_env.globals.update(enumerate=enumerate)  # Make enumerate available in templates
+log = configure_logging('annotation')
 
 # Global variables
-SESSIONS = dict()
+SECRET_KEY_FILE = '.flask_secret_key'
 INPUT_JSONL = 'data'
 BATCH_COUNT_FILE = 'batch_count.json'
 TRIAL_MODE = False
 batch_size = 30
-data = None
+data = None  # DatasetSnapshot of the study's items
 batches = None
 batch_counts = None
+data_by_id = None  # ID -> record, decoded on demand
+batches_by_id = None  # batch_id -> batch
+state_storage = None  # Sessions, batch assignments and (with the 'store' backend) annotations
+session_store = None
+batch_allocator = None
+annotation_sink = None
+image_cache = None  # None serves images straight from their source URLs
+image_urls = None  # url_key -> source URL, only these are proxied
+render_cache = None
+metrics = None  # Registry behind /metrics, set up by init_app
+RENDER_CACHE_SIZE = 1024  # pre-rendered question bodies kept per worker
+QUESTION_TEMPLATE = 'annotation_body.html'
+API_MAX_ITEMS = 5  # items returned by one /api/items call at most
+DEFAULT_GPT_ANSWER = {
+    'overall_confidence': 'N/A',
+    'background_color': {'suggestion': 'N/A', 'confidence': 'N/A'},
+    'text_elements': {'suggestions': [], 'confidence': 'N/A'},
+    'visual_elements': {'suggestions': [], 'confidence': 'N/A'},
+    'review_notes': []
+}
 
-def init_app(trial_mode=False):
-    """Initialize app settings based on mode"""
-    global INPUT_JSONL, BATCH_COUNT_FILE, TRIAL_MODE, batch_size, data, batches, batch_counts
+class RenderCache:
+    """LRU of rendered question bodies keyed by (qid, template version)"""
+    def __init__(self, size=RENDER_CACHE_SIZE, version=''):
+        self.size = size
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_render(self, qid, render):
+        key = (qid, self.version)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.render_cache.inc(result='hit')
+                return self.entries[key]
+        metrics.render_cache.inc(result='miss')
+        with metrics.stage.time(stage='render_body'):
+            body = Markup(render())
+        if self.size:
+            with self.lock:
+                self.entries[key] = body
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return body
+
+def template_version(*parts):
+    """Changes whenever the question template or anything else baked into the rendered body changes"""
+    source = app.jinja_env.loader.get_source(app.jinja_env, QUESTION_TEMPLATE)[0]
+    return hashlib.sha256(repr((source,) + parts).encode('utf-8')).hexdigest()[:16]
+
+def init_app(trial_mode=False, annotation_backend='jsonl', response_shards=None, image_proxy=True,
+             render_cache_size=RENDER_CACHE_SIZE, log_level=logging.INFO, state_db=None):
+    """Initialize app settings based on mode; `state_db` is a SQLite path or 'memory' (single process only)"""
+    global INPUT_JSONL, BATCH_COUNT_FILE, TRIAL_MODE, batch_size, data, batches, batch_counts, data_by_id, batches_by_id, state_storage, session_store, batch_allocator, annotation_sink, image_cache, image_urls, render_cache, metrics
     
+    log.setLevel(log_level)
     TRIAL_MODE = trial_mode
     if TRIAL_MODE:
         INPUT_JSONL = 'data_with_gpt_trial'
         BATCH_COUNT_FILE = 'batch_count_trial.json'
         batch_size = 5
-        print("Running in trial mode")
+        log.info("Running in trial mode")
     else:
         INPUT_JSONL = 'data_with_gpt'
         BATCH_COUNT_FILE = 'batch_count.json'
         batch_size = 30
-        print("Running in full mode")
+        log.info("Running in full mode")
 
-    # Initialize all data-dependent variables
+    # Initialize all data-dependent variables; the batch layout is frozen in the snapshot
     data = load_data()
-    print("Total length of data: ", len(data))
-    batches = shuffle_and_batch_data(data, batch_size)
-    print("Total length of batches: ", len(batches))
-    batch_counts = initialize_batch_counts(batches)
+    batch_size = data.batch_size
+    batches = data.batches
+    log.info("Dataset snapshot %s: %d items in %d batches", data.snapshot_id, len(data), len(batches))
+    batch_counts = initialize_batch_counts(batches, data.snapshot_id)
+    data_by_id = data
+    batches_by_id = {batch['batch_id']: batch for batch in batches}
+
+    app.secret_key = load_secret_key()
+    app.permanent_session_lifetime = timedelta(seconds=SESSION_TTL)
+    if state_db is None:
+        state_db = f"{os.path.splitext(STATE_DB)[0]}_trial.db" if TRIAL_MODE else STATE_DB
+    state_storage = open_storage(state_db)
+    check_state_snapshot(state_storage, data.snapshot_id)
+    session_store = state_storage.sessions
+    # Existing batch_count.json counts are carried over into the allocator the first time it sees a batch
+    batch_allocator = state_storage.batches
+    batch_allocator.seed(batch_counts)
+    if metrics is not None:
+        metrics.close()
+    metrics = AppMetrics(f"{METRICS_DIR}_trial" if TRIAL_MODE else METRICS_DIR)
+
+    if annotation_sink is not None:
+        annotation_sink.close()
+    if annotation_backend in ('store', 'sqlite'):
+        annotation_sink = state_storage.annotation_sink(on_saved=metrics.annotations_saved)
+    else:
+        annotation_sink = JsonlAnnotationSink(RESPONSE_DIR, shards=response_shards, on_saved=metrics.annotations_saved)
+
+    image_cache = ImageCache(IMAGE_CACHE_DIR) if image_proxy else None
+    image_urls = {url_key(url): url for url in data.image_urls} if image_proxy else {}
+    render_cache = RenderCache(render_cache_size, template_version(data.snapshot_id, image_proxy))
+
+def create_app(trial_mode=False, annotation_backend='jsonl', response_shards=None, image_proxy=True,
+               render_cache_size=RENDER_CACHE_SIZE, log_level=logging.INFO, state_db=None):
+    """App factory for WSGI servers, e.g. gunicorn -w 4 'app:create_app()'"""
+    init_app(trial_mode=trial_mode, annotation_backend=annotation_backend, response_shards=response_shards,
+             image_proxy=image_proxy, render_cache_size=render_cache_size, log_level=log_level, state_db=state_db)
+    return app
+
+class AppMetrics(MetricsRegistry):
+    """Route timers, per-stage timers and study counters served on /metrics"""
+    def __init__(self, directory=METRICS_DIR):
+        super().__init__(directory)
+        self.requests = self.counter('annotation_http_requests_total', 'HTTP requests by route, method and status')
+        self.request_time = self.histogram('annotation_http_request_duration_seconds', 'Time spent handling a request, by route and method')
+        self.stage = self.histogram('annotation_stage_duration_seconds', 'Time spent in each stage of request handling')
+        self.assignments = self.counter('annotation_batch_assignments_total', 'Batches leased to participants')
+        self.submissions = self.counter('annotation_submissions_total', 'Annotations submitted')
+        self.completions = self.counter('annotation_sessions_completed_total', 'Participants who reached /end')
+        self.save_latency = self.histogram('annotation_save_latency_seconds', 'Time from submission until the annotation is on disk',
+                                           buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 5.0, 10.0, 30.0))
+        self.save_errors = self.counter('annotation_save_errors_total', 'Annotation batches the sink failed to write')
+        self.render_cache = self.counter('annotation_render_cache_total', 'Question body lookups by result')
+        self.gauge('annotation_active_sessions', 'Sessions active within the session TTL', lambda: session_store.count_active())
+
+    def annotations_saved(self, latencies, error):
+        if error is not None:
+            self.save_errors.inc()
+        for latency in latencies:
+            self.save_latency.observe(latency)
+
+def load_secret_key():
+    """Cookie signing key shared by all workers: from the environment, else from a key file created once"""
+    if os.environ.get('ANNOTATION_SECRET_KEY'):
+        return os.environ['ANNOTATION_SECRET_KEY']
+    if not os.path.exists(SECRET_KEY_FILE):
+        # The key is complete before it appears under its name, and only the first worker's key is published,
+        # so every worker ends up reading the same, fully written key
+        try:
+            with atomic_write(SECRET_KEY_FILE, exclusive=True) as file:
+                file.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass
+    with open(SECRET_KEY_FILE, 'r') as file:
+        key = file.read().strip()
+    if not key:
+        raise RuntimeError(f"{SECRET_KEY_FILE} is empty; delete it so a new key is generated")
+    return key
 
 def load_data():
-    with open(f'{INPUT_JSONL}.jsonl', 'r') as file:
-        return [json.loads(line) for line in file]
-
-def shuffle_and_batch_data(data, batch_size):
-    random.shuffle(data)
-    batches_with_ids = []
-    for i in range(0, len(data), batch_size):
-        batch = data[i:i + batch_size]
-        batch_id = i // batch_size + 1
-        batches_with_ids.append({'batch_id': batch_id, 'batch_data': batch})
-    return batches_with_ids
-
-def initialize_batch_counts(batches):
+    """Open the dataset snapshot, building it on first start; records are decoded lazily from a shared memory map"""
+    if data is not None:
+        data.close()
+    source = f'{INPUT_JSONL}.jsonl'
+    path = snapshot_path_for(source)
+    if not os.path.exists(path):
+        # Deterministic, so workers racing to build it write the same file
+        log.info("Building dataset snapshot %s from %s", path, source)
+        build_snapshot(source, path, batch_size)
+    snapshot = DatasetSnapshot(path, transform=prepare_record)
+    if snapshot.is_stale(source):
+        log.warning("%s changed since %s was built; serving the snapshot. Rebuild it with "
+                    "'python dataset_snapshot.py build --input %s --batch-size %d' and start with fresh batch counts "
+                    "to use the new data", source, path, source, snapshot.batch_size)
+    return snapshot
+
+def prepare_record(record):
+    """Display normalization applied once when a record is decoded"""
+    # Replace _ to " " in images
+    for image in record['images']:
+        image["content"] = image["content"].replace("_", " ")
+    return record
+
+def initialize_batch_counts(batches, snapshot_id):
+    """Load the batch counts, refusing counts that were made for another snapshot's batches"""
     if not os.path.exists(BATCH_COUNT_FILE):
         batch_counts = {batch['batch_id']: 0 for batch in batches}
-        save_batch_counts(batch_counts)
+        save_batch_counts(batch_counts, snapshot_id)
     else:
-        with open(BATCH_COUNT_FILE, 'r') as file:
-            batch_counts = json.load(file)
-    
-    print(f"Batch counts initialized: {batch_counts}")    
+        batch_counts, counts_snapshot = read_batch_counts(BATCH_COUNT_FILE)
+        if counts_snapshot is None:
+            # Written before snapshots existed; adopt it unless it has counts for batches this layout does not have,
+            # which would be lost. Batches it lacks start at zero, as they would have in the old app
+            known = [str(batch['batch_id']) for batch in batches]
+            known_ids = set(known)
+            lost = {batch_id: count for batch_id, count in batch_counts.items() if batch_id not in known_ids and count}
+            if lost:
+                raise SnapshotMismatch(f"{BATCH_COUNT_FILE} has counts for batches {sorted(lost, key=int)} that dataset "
+                                       f"snapshot {snapshot_id} does not have; it was made for another batch layout, "
+                                       f"move it away to start counting anew")
+            backup = f"{BATCH_COUNT_FILE}.legacy"
+            if not os.path.exists(backup):
+                shutil.copy2(BATCH_COUNT_FILE, backup)
+            batch_counts = {batch_id: batch_counts.get(batch_id, 0) for batch_id in known}
+            save_batch_counts(batch_counts, snapshot_id)
+            log.info("Stamped %s with dataset snapshot %s; the original is kept as %s", BATCH_COUNT_FILE, snapshot_id, backup)
+        elif counts_snapshot != snapshot_id:
+            raise SnapshotMismatch(f"{BATCH_COUNT_FILE} was produced for dataset snapshot {counts_snapshot}, "
+                                   f"but the dataset is snapshot {snapshot_id}; move it away to start counting anew")
+
+    log.info("Batch counts initialized: %d batches, %d assignments", len(batch_counts), sum(batch_counts.values()))
     return batch_counts
 
-def save_batch_counts(batch_counts):
+def save_batch_counts(batch_counts, snapshot_id):
     """Save the batch assignment counts to a file."""
-    with open(BATCH_COUNT_FILE, 'w') as file:
-        json.dump(batch_counts, file)
+    write_batch_counts(BATCH_COUNT_FILE, batch_counts, snapshot_id)
 
-def get_least_assigned_batch(batch_counts):
-    """Get the batch with the lowest assignment count."""
-    return min(batch_counts, key=batch_counts.get)
+def check_state_snapshot(storage, snapshot_id):
+    """Bind the state database to the dataset snapshot; its batch leases and counts are meaningless for another"""
+    current = storage.get_meta(SNAPSHOT_META_KEY)
+    if current is None:
+        storage.set_meta(SNAPSHOT_META_KEY, snapshot_id)
+    elif current != snapshot_id:
+        raise SnapshotMismatch(f"State database {storage.path} holds batches of dataset snapshot {current}, "
+                               f"but the dataset is snapshot {snapshot_id}; use a fresh --state-db")
 
 def generate_session_id():
     return str(uuid.uuid4())
 
-session_id = generate_session_id()
-print(f"Assigned session ID: {session_id}")
-SESSIONS[session_id] = {
-    'prolific_id': None,
-    'user_batch_ids': None,
-    'user_batch_unique_id': None,
-    'index': None,
-    'design_usage': None,
-    'adobe_app': None,
-    'qid': None,
-    'user_query': None,
-    'background_color': None,
-    'text_elemnets': None,
-    'explanation': None,
-    'image_ranks': None,
-    'user_batch_ids': None,
-}
-session = SESSIONS[session_id]
-
-RESPONSE_DIR = 'responses'  # Directory to store responses
+def new_session_data():
+    return {
+        'prolific_id': None,
+        'user_batch_ids': None,
+        'user_batch_unique_id': None,
+        'index': None,
+        'design_usage': None,
+        'adobe_app': None,
+        'qid': None,
+        'user_query': None,
+        'background_color': None,
+        'text_elemnets': None,
+        'explanation': None,
+        'image_ranks': None,
+    }
+
+class SessionData(dict):
+    """Session dict that remembers whether it needs to be written back to the store"""
+    modified = False
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.modified = True
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+def record_request(status):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.requests.inc(route=route, method=request.method, status=str(status))
+    metrics.request_time.observe(time.perf_counter() - g.request_start, route=route, method=request.method)
+
+@app.after_request
+def time_request(response):
+    # after_request functions run in reverse order, so this one runs after save_session
+    record_request(response.status_code)
+    g.request_recorded = True
+    return response
+
+@app.teardown_request
+def time_failed_request(error):
+    if error is not None and 'request_start' in g and not g.get('request_recorded'):
+        record_request(500)
+
+@app.before_request
+def load_session():
+    if request.endpoint in ('metrics_endpoint', 'image', 'static'):
+        return  # These do not touch the participant's session
+    session_id = cookie_session.get('sid')
+    if session_id is None:
+        session_id = generate_session_id()
+        cookie_session['sid'] = session_id
+        cookie_session.permanent = True
+        log.debug("Assigned session ID: %s", session_id)
+    with metrics.stage.time(stage='session_load'):
+        stored = session_store.get(session_id)
+    g.session_id = session_id
+    g.session = SessionData(stored if stored is not None else new_session_data())
+
+@app.after_request
+def save_session(response):
+    if g.get('session') is not None and g.session.modified:
+        with metrics.stage.time(stage='session_save'):
+            session_store.save(g.session_id, g.session)
+    return response
+
+session = LocalProxy(lambda: g.session)  # The current participant's session data
 
 def save_annotation_to_file(session_data):
-    if not os.path.exists(RESPONSE_DIR):
-        os.makedirs(RESPONSE_DIR, exist_ok=True)
-    annotator_id = session_data.get('prolific_id', 'unknown')
-    save_name = time.strftime("%Y%m%d-%H%M%S")  # Timestamp
-    response_file = os.path.join(RESPONSE_DIR, f'{annotator_id}_{save_name}.jsonl')
-
-    with open(response_file, 'a', encoding='utf-8') as f:
-        json.dump(session_data, f)
-        f.write('\n')
-
-    print(f"Saved annotation to {response_file}")
+    """Queue an annotation; the sink's writer thread appends it to the annotator's file"""
+    session_data['timestamp'] = time.strftime("%Y%m%d-%H%M%S")
+    annotation_sink.write(session_data)
+    metrics.submissions.inc()
+    log.debug("Queued annotation for %s (qid %s)", session_data.get('prolific_id'), session_data.get('qid'))
+
+@app.template_filter('image_src')
+def image_src(url, width=DEFAULT_THUMB_WIDTH):
+    """Local thumbnail route for a dataset image URL"""
+    if image_cache is None:
+        return url
+    return url_for('image', key=url_key(url), w=width)
+
+@app.route('/image/<key>')
+def image(key):
+    url = image_urls.get(key)
+    if url is None:
+        abort(404)
+    width = request.args.get('w', DEFAULT_THUMB_WIDTH, type=int)
+    if width not in THUMB_WIDTHS:
+        abort(400)
+    # Never download on the request path: a miss sends the browser to the source while the cache fills in the background
+    digest = image_cache.cached(url)
+    if digest is None:
+        image_cache.fetch_later(url, widths=(width,))
+        return redirect(url)
+    try:
+        payload, mimetype = image_cache.thumbnail(digest, width)
+    except Exception as e:
+        log.warning("Cannot render %s: %s", url, e)
+        return redirect(url)
+    response = send_file(io.BytesIO(payload), mimetype=mimetype, etag=f'{digest[:32]}-{width}',
+                         max_age=365 * 24 * 3600, conditional=True)
+    response.headers['Cache-Control'] += ', immutable'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the whole server's metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def intro():
@@ -134,26 +385,19 @@ def save_prolific():
     prolific_id = request.form.get('prolific_id')
     session['prolific_id'] = prolific_id
 
-    with open(BATCH_COUNT_FILE, 'r') as file:
-        batch_counts = json.load(file)
-    
-    least_assigned_batch_id = get_least_assigned_batch(batch_counts)
-    
-    print(f"Available batch IDs: {[batch['batch_id'] for batch in batches]}")
+    # Leases the least assigned batch; the lease expires unless the participant reaches /end
+    with metrics.stage.time(stage='batch_assign'):
+        least_assigned_batch_id = str(batch_allocator.assign(g.session_id))
+    metrics.assignments.inc()
 
     try:
-        user_batch_info = next(batch for batch in batches if batch['batch_id'] == int(least_assigned_batch_id))
-    except StopIteration:
+        user_batch_info = batches_by_id[int(least_assigned_batch_id)]
+    except KeyError:
         raise ValueError(f"No batch found with batch_id {least_assigned_batch_id}")
     
-    user_batch = user_batch_info['batch_data']
-    
-    session['user_batch_ids'] = [item['ID'] for item in user_batch]
+    session['user_batch_ids'] = list(user_batch_info['batch_ids'])
     session['user_batch_unique_id'] = least_assigned_batch_id
-    print(f"Assigned user_batch_unique_id: {least_assigned_batch_id}")
-
-    batch_counts[least_assigned_batch_id] += 1
-    save_batch_counts(batch_counts)
+    log.info("Assigned batch %s to %s", least_assigned_batch_id, prolific_id)
 
     session['index'] = 0
     return redirect(url_for('design_tool'))
@@ -184,86 +428,148 @@ def start():
 
 @app.route('/end')
 def end():
-    print(f"Session {session_id} completed.")
+    with metrics.stage.time(stage='lease_complete'):
+        completed = batch_allocator.complete(g.session_id, session.get('user_batch_unique_id'))
+    if completed:
+        metrics.completions.inc()
+        with metrics.stage.time(stage='export_counts'):
+            batch_allocator.export_counts(BATCH_COUNT_FILE, data.snapshot_id)
+    log.info("Session %s completed", g.session_id)
     return render_template('end.html')
 
+def submit_annotation(current_data, form):
+    """Save the answers to the participant's current item from a posted annotate form and move on to the next item"""
+    qid = current_data['ID']
+    design_choices = current_data['design_choices']
+    images = current_data['images']
+    background_color = form.get('background_color')
+    explanation = form.get('explanation')
+
+    text_alignments = {}
+    if 'text' in design_choices:
+        for text_item in design_choices['text'].keys():
+            alignment_response = form.get(text_item)
+            text_item_r = text_item.replace("_", " ")
+            text_alignments[text_item_r] = alignment_response
+
+    image_ranks = {}
+    for i, image_set in enumerate(images):
+        image_ranks[f'rank_image_{i+1}'] = {}
+        for j in range(len(image_set['urls'])):
+            rank_key = f'rank_image_{i+1}_{j+1}'
+            rank_value = form.get(rank_key)
+            image_ranks[f'rank_image_{i+1}'][f'image_{j+1}'] = rank_value
+
+    session_data = {
+        'session_id': g.session_id,
+        'prolific_id': session.get('prolific_id'),
+        'user_batch_unique_id': session.get('user_batch_unique_id'),
+        'design_usage': session.get('design_usage'),
+        'adobe_app': session.get('adobe_app'),
+        'qid': qid,
+        'user_query': current_data['user_query'],
+        'background_color': background_color,
+        'text_elements': text_alignments,
+        'explanation': explanation,
+        'image_ranks': image_ranks,
+        'user_batch_ids': session.get('user_batch_ids'),
+    }
+
+    with metrics.stage.time(stage='annotation_enqueue'):
+        save_annotation_to_file(session_data)  # Save each row separately
+    with metrics.stage.time(stage='lease_renew'):
+        batch_allocator.renew(g.session_id, session.get('user_batch_unique_id'))
+    session['index'] = session.get('index', 0) + 1
+
+def question_body(current_data):
+    # The question body only depends on the item, so it is rendered once per worker
+    return render_cache.get_or_render(current_data['ID'], lambda: render_template(
+        QUESTION_TEMPLATE,
+        user_query=current_data['user_query'],
+        design_choices=current_data['design_choices'],
+        images=current_data['images'],
+        gpt_answer=current_data.get('gpt_answer', DEFAULT_GPT_ANSWER)))
+
 @app.route('/annotate', methods=['GET', 'POST'])
 def annotate():
+    """Server-rendered page per item; also the fallback of the JSON API the page uses when scripts run"""
     index = session.get('index', 0)
     user_batch_ids = session.get('user_batch_ids')
-    user_batch_unique_id = session.get('user_batch_unique_id')
-    
+
+    if user_batch_ids is None:
+        # No batch assigned yet, or the session expired
+        return redirect(url_for('prolific'))
     if index >= len(user_batch_ids):
         return redirect(url_for('end'))
 
-    current_data = next(item for item in data if item['ID'] == user_batch_ids[index])
-    qid = current_data['ID']
-    user_query = current_data['user_query']
-    design_choices = current_data['design_choices']
-    images = current_data['images']
-    # Get GPT answer if it exists in the data
-    gpt_answer = current_data.get('gpt_answer', {
-        'overall_confidence': 'N/A',
-        'background_color': {'suggestion': 'N/A', 'confidence': 'N/A'},
-        'text_elements': {'suggestions': [], 'confidence': 'N/A'},
-        'visual_elements': {'suggestions': [], 'confidence': 'N/A'},
-        'review_notes': []
-    })
-
+    current_data = data_by_id[user_batch_ids[index]]
     if request.method == 'POST':
-        background_color = request.form.get('background_color')
-        explanation = request.form.get('explanation')
-
-        text_alignments = {}
-        if 'text' in design_choices:
-            for text_item in design_choices['text'].keys():
-                alignment_response = request.form.get(text_item)
-                text_item_r = text_item.replace("_", " ")
-                text_alignments[text_item_r] = alignment_response
-
-        image_ranks = {}
-        for i, image_set in enumerate(images):
-            image_ranks[f'rank_image_{i+1}'] = {}
-            for j in range(len(image_set['urls'])):
-                rank_key = f'rank_image_{i+1}_{j+1}'
-                rank_value = request.form.get(rank_key)
-                image_ranks[f'rank_image_{i+1}'][f'image_{j+1}'] = rank_value
-
-        session_data = {
-            'session_id': session_id,
-            'prolific_id': session.get('prolific_id'),
-            'user_batch_unique_id': user_batch_unique_id,
-            'design_usage': session.get('design_usage'),
-            'adobe_app': session.get('adobe_app'),
-            'qid': qid,
-            'user_query': user_query,
-            'background_color': background_color,
-            'text_elements': text_alignments,
-            'explanation': explanation,
-            'image_ranks': image_ranks,
-            'user_batch_ids': user_batch_ids,
-        }
-        
-        save_annotation_to_file(session_data)  # Save each row separately
-
-        session['index'] = index + 1
+        submit_annotation(current_data, request.form)
         return redirect(url_for('annotate'))
 
-    # Replace _ to " " in images
-    for image in images:
-        image["content"] = image["content"].replace("_", " ")
+    body = question_body(current_data)
+    with metrics.stage.time(stage='render_page'):
+        return render_template('annotation_r.html', 
+                             index=index, 
+                             total=len(user_batch_ids),
+                             question_body=body)
+
+def api_error(error, status):
+    """JSON error telling the page where the server-rendered flow continues"""
+    return jsonify(error=error, fallback=url_for('annotate')), status
 
-    return render_template('annotation_r.html', 
-                         index=index, 
-                         user_query=user_query, 
-                         design_choices=design_choices, 
-                         images=images,
-                         gpt_answer=gpt_answer)
+@app.route('/api/items')
+def api_items():
+    """Items of the participant's batch from position `start` (default: the current one), for prefetching"""
+    user_batch_ids = session.get('user_batch_ids')
+    if user_batch_ids is None:
+        return api_error('no_batch', 409)
+    index = session.get('index', 0)
+    start = max(0, request.args.get('start', index, type=int))
+    count = min(max(1, request.args.get('count', 1, type=int)), API_MAX_ITEMS)
+
+    items = []
+    for position in range(start, min(start + count, len(user_batch_ids))):
+        current_data = data_by_id[user_batch_ids[position]]
+        items.append({
+            'position': position,
+            'qid': current_data['ID'],
+            'body': str(question_body(current_data)),
+            'images': [image_src(url) for image_set in current_data['images'] for url in image_set['urls']],
+        })
+    return jsonify(index=index, total=len(user_batch_ids), items=items)
+
+@app.route('/api/annotations', methods=['POST'])
+def api_submit_annotation():
+    """Accept the annotate form of the item at `position`; a repeated submission of a saved item is acknowledged, not saved twice"""
+    user_batch_ids = session.get('user_batch_ids')
+    if user_batch_ids is None:
+        return api_error('no_batch', 409)
+    index = session.get('index', 0)
+    position = request.form.get('position', type=int)
+    if position is None:
+        return api_error('missing_position', 400)
+
+    accepted = position == index and index < len(user_batch_ids)
+    if accepted:
+        submit_annotation(data_by_id[user_batch_ids[index]], request.form)
+        index += 1
+    elif position > index:
+        # An earlier item was never saved; the page starts over from the server's position
+        return api_error('out_of_order', 409)
+    return jsonify(accepted=accepted, index=index, total=len(user_batch_ids),
+                   done=index >= len(user_batch_ids), end=url_for('end'))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run annotation web app')
     parser.add_argument('--trial', action='store_true', help='Run in trial mode')
+    parser.add_argument('--annotation-backend', choices=['jsonl', 'store', 'sqlite'], default='jsonl', help="Where annotations are stored: JSONL files, or the state store ('sqlite' is an alias of 'store')")
+    parser.add_argument('--state-db', default=None, help=f"SQLite file shared by all workers (default {STATE_DB}), or '{MEMORY}' for a single process")
+    parser.add_argument('--no-image-proxy', action='store_true', help='Serve images from their source URLs instead of the local image cache')
+    parser.add_argument('--response-shards', type=int, default=None, help='Spread JSONL annotations over this many shard files instead of one file per annotator')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='Lowest level of log messages to show')
     args = parser.parse_args()
     
-    init_app(trial_mode=args.trial)
+    init_app(trial_mode=args.trial, annotation_backend=args.annotation_backend, response_shards=args.response_shards,
+             image_proxy=not args.no_image_proxy, log_level=args.log_level, state_db=args.state_db)
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,34 @@
+"""Atomic file writes shared by everything that rewrites state files in place.
+
+The content goes to a temporary file in the target's directory, is fsynced,
+and only then renamed over the target, so readers and a crash see either the
+old file or the new one. The temporary file is removed if writing fails.
+"""
+import contextlib
+import os
+import tempfile
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', fsync=True, exclusive=False, **kwargs):
+    """Open a temporary file that replaces `path` when the block exits without an error.
+
+    With `exclusive`, the file is only published if `path` does not exist yet,
+    and FileExistsError is raised otherwise. `fsync=False` is for files that
+    are cheap to lose, such as metrics.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as file:
+            yield file
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        if exclusive:
+            os.link(tmp_path, path)
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
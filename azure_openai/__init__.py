@@ -1,3 +1,3 @@
 # azure_openai/__init__.py  
   
-from .aoai_gpt import AoaiGptInterface  
+from .aoai_gpt import AoaiGptInterface, DeploymentPool, TokenBucket  
@@ -1,4 +1,4 @@
-import base64, requests, configparser, os, argparse, json, random
+import base64, hashlib, requests, configparser, os, argparse, json, random, threading, time
 from openai import AzureOpenAI
 
 current_path = os.path.dirname(os.path.realpath(__file__))
@@ -16,6 +16,10 @@ DEFAULT_CONFIG_LABEL = ['BB-o1'] # add your configuration label here, e.g. ['def
 
 DEFAULT_SYS_PROMPT = "You are trained to interpret images about people and make responsible assumptions about them."
 MAX_IMAGE_COUNT = 2
+DEFAULT_CAPACITY = 4 # max in-flight requests per deployment, override with `capacity = N` in the config section
+COOLDOWN_SECONDS = 30 # how long a throttled or failing deployment is taken out of rotation
+LATENCY_SMOOTHING = 0.2 # weight of the newest sample in the per-deployment latency average
+DEFAULT_BURST = 1 # requests a deployment may send back to back, override with `burst = N` in the config section
 
 
 class AoaiGptInterface:
@@ -26,33 +30,54 @@ class AoaiGptInterface:
         self.config_labels = CONFIG_LABEL
         self.config = configparser.ConfigParser()
         self.config.read(CONFIG_FILE)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.encoded_images = {} # (path, mtime, size) -> base64, and content hash -> base64
+
+    def get_client(self, label):
+        """
+        Returns the client for a configuration label, creating it on first use.
+        """
+        with self.clients_lock:
+            if label not in self.clients:
+                try:
+                    api_base = self.config.get(label, 'api_base')
+                    api_key = self.config.get(label, 'api_key')
+                    api_version = self.config.get(label, 'api_version')
+                    deployment_name = self.config.get(label, 'engine')
+                except Exception as e:
+                    raise Exception(f"Error reading configuration file: {e}")
+                client = AzureOpenAI(
+                    api_key=api_key,
+                    api_version=api_version,
+                    base_url=f"{api_base}/openai/deployments/{deployment_name}"
+                )
+                self.clients[label] = (client, deployment_name, api_base, api_key, api_version)
+            return self.clients[label]
 
     def select_config(self):
         """
         Selects a configuration from the config file.
         """
-        try:
-            chosen_label = random.choice(self.config_labels)
-            self.api_base = self.config.get(chosen_label, 'api_base')
-            self.api_key = self.config.get(chosen_label, 'api_key')
-            self.api_version = self.config.get(chosen_label, 'api_version')
-            self.deployment_name = self.config.get(chosen_label, 'engine')
-        except Exception as e:
-            raise Exception(f"Error reading configuration file: {e}")
-        
-        self.client = AzureOpenAI(
-            api_key=self.api_key,
-            api_version=self.api_version,
-            base_url=f"{self.api_base}/openai/deployments/{self.deployment_name}"
-        )
+        chosen_label = random.choice(self.config_labels)
+        self.client, self.deployment_name, self.api_base, self.api_key, self.api_version = self.get_client(chosen_label)
         # print(f"Base URL: {self.api_base}")
 
     def encode_image(self, image_path):
         """
-        Encodes an image to a base64 string.
+        Encodes an image to a base64 string. Results are memoized, so an unchanged file is read once
+        and identical files are encoded once.
         """
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('ascii')
+        stat = os.stat(image_path)
+        file_key = (os.path.realpath(image_path), stat.st_mtime_ns, stat.st_size)
+        if file_key not in self.encoded_images:
+            with open(image_path, "rb") as image_file:
+                payload = image_file.read()
+            content_key = hashlib.sha256(payload).hexdigest()
+            if content_key not in self.encoded_images:
+                self.encoded_images[content_key] = base64.b64encode(payload).decode('ascii')
+            self.encoded_images[file_key] = self.encoded_images[content_key]
+        return self.encoded_images[file_key]
 
     def call_vision_api(self, image_path, prompt, sys_prompt=DEFAULT_SYS_PROMPT):
         """
@@ -111,6 +136,161 @@ class AoaiGptInterface:
         return response.model_dump()
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter; a rate of 0 or less disables the limit.
+    """
+    def __init__(self, rate, capacity=DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_time(self, now):
+        """
+        Returns the seconds until a token is available, 0 if one is available now.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """
+        Consumes a token that wait_time reported as available.
+        """
+        if self.rate > 0:
+            with self.lock:
+                self.tokens -= 1
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then consumes it.
+        """
+        while True:
+            wait = self.wait_time(time.monotonic())
+            if wait == 0:
+                self.take()
+                return
+            time.sleep(wait)
+
+
+class Deployment:
+    """
+    Runtime state of one configuration label inside a DeploymentPool.
+    """
+    def __init__(self, label, client, deployment_name, capacity, rate=0, burst=DEFAULT_BURST):
+        self.label = label
+        self.client = client
+        self.deployment_name = deployment_name
+        self.capacity = capacity
+        self.bucket = TokenBucket(rate, burst)
+        self.last_used = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.latency = None
+        self.cooldown_until = 0.0
+
+    def available(self, now):
+        return self.cooldown_until <= now and self.in_flight < self.capacity
+
+    def stats(self):
+        return {
+            'label': self.label,
+            'deployment': self.deployment_name,
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'server_errors': self.server_errors,
+            'avg_latency': round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class DeploymentPool:
+    """
+    Spreads requests across all configured labels.
+
+    Every deployment has its own rate bucket of `rate` requests per second, or the
+    `rate = N` of its config section, so each label's quota adds to the throughput.
+    Each request goes to the least recently used deployment that has a free slot and
+    a token, so labels take turns and one that has used up its quota sits out.
+    Deployments answering with 429 or 5xx are taken out of rotation for a cooldown
+    period. One client is kept per label.
+    """
+    def __init__(self, gpt_interface, cooldown=COOLDOWN_SECONDS, rate=0, burst=DEFAULT_BURST):
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+        self.deployments = []
+        for label in gpt_interface.config_labels:
+            client, deployment_name = gpt_interface.get_client(label)[:2]
+            capacity = gpt_interface.config.getint(label, 'capacity', fallback=DEFAULT_CAPACITY)
+            label_rate = gpt_interface.config.getfloat(label, 'rate', fallback=rate)
+            label_burst = gpt_interface.config.getint(label, 'burst', fallback=burst)
+            self.deployments.append(Deployment(label, client, deployment_name, capacity, label_rate, label_burst))
+        if not self.deployments:
+            raise ValueError("Error: No configuration labels given for the deployment pool.")
+
+    def acquire(self):
+        """
+        Blocks until a deployment has free capacity and a rate token, and reserves a slot on it.
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                candidates = [d for d in self.deployments if d.available(now)]
+                waits = [d.bucket.wait_time(now) for d in candidates]
+                ready = [d for d, wait in zip(candidates, waits) if wait == 0]
+                if ready:
+                    deployment = min(ready, key=lambda d: d.last_used)
+                    deployment.bucket.take()
+                    deployment.last_used = now
+                    deployment.in_flight += 1
+                    deployment.requests += 1
+                    return deployment
+                timeouts = waits + [d.cooldown_until - now for d in self.deployments if d.cooldown_until > now]
+                # Wake up when a token is due or a cooldown ends, or earlier if a slot is released
+                self.condition.wait(timeout=min(timeouts) if timeouts else None)
+
+    def release(self, deployment, latency=None, status_code=None, retry_after=None, backoff=None):
+        """
+        Frees the slot taken by acquire and records the outcome of the request.
+
+        A throttled or failing deployment cools down for the server's Retry-After hint,
+        or for the pool's cooldown without one. The last deployment in rotation is never
+        taken out for longer than `backoff`, the time the caller waits before retrying.
+        """
+        with self.condition:
+            deployment.in_flight -= 1
+            if status_code == 429:
+                deployment.throttled += 1
+            elif status_code is not None and status_code >= 500:
+                deployment.server_errors += 1
+            if status_code == 429 or (status_code is not None and status_code >= 500):
+                now = time.monotonic()
+                cooldown = retry_after if retry_after is not None else self.cooldown
+                if backoff is not None and not any(d is not deployment and d.cooldown_until <= now for d in self.deployments):
+                    cooldown = min(cooldown, backoff)
+                deployment.cooldown_until = now + cooldown
+                print(f"Deployment {deployment.label} returned {status_code}, cooling down for {cooldown:.1f}s")
+            elif latency is not None:
+                if deployment.latency is None:
+                    deployment.latency = latency
+                else:
+                    deployment.latency += LATENCY_SMOOTHING * (latency - deployment.latency)
+            self.condition.notify_all()
+
+    def deployment_names(self):
+        return list(dict.fromkeys(d.deployment_name for d in self.deployments))
+
+    def stats(self):
+        with self.condition:
+            return [d.stats() for d in self.deployments]
+
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calling GPT Vision API.")
@@ -0,0 +1,106 @@
+import hashlib, json, sqlite3, threading, time
+
+DEFAULT_CACHE_FILE = 'gpt_response_cache.db'
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024 # total size of cached responses before the least recently used are evicted
+DEFAULT_MAX_AGE_DAYS = 30 # cached responses older than this are never returned
+EVICT_EVERY = 100 # puts between eviction passes
+
+
+def cache_key(deployment_name, sys_prompt, user_prompt, image_urls):
+    """
+    Hashes everything that determines a model answer into a cache key.
+    """
+    payload = json.dumps([deployment_name, sys_prompt, user_prompt, list(image_urls)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of raw model answers with size and age based eviction.
+    """
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_bytes=DEFAULT_MAX_BYTES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, deployment TEXT, content TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self.conn.commit()
+        self.evict()
+
+    def get(self, key):
+        """
+        Returns the cached answer for a key, or None.
+        """
+        return self.get_any([key])
+
+    def get_any(self, keys):
+        """
+        Returns the cached answer of the first key that has one, or None. Counts as one hit or miss
+        however many keys are given, e.g. one per deployment that could have answered the request.
+        """
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                row = self.conn.execute(
+                    "SELECT content FROM responses WHERE key = ? AND created_at >= ?", (key, now - self.max_age)
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self.conn.commit()
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, content, deployment_name=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, deployment_name, content, len(content.encode('utf-8')), now, now)
+            )
+            self.conn.commit()
+            self.puts += 1
+            due = self.puts % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Drops expired answers, then the least recently used ones until the cache fits in max_bytes.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                freed = 0
+                stale = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    if total - freed <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    freed += size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else None,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
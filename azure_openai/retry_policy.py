@@ -0,0 +1,66 @@
+import email.utils, json, random, time
+import openai
+
+DEFAULT_BASE_DELAY = 1.0 # seconds before the first retry, doubled on every attempt
+DEFAULT_MAX_DELAY = 60.0 # upper bound for a single backoff
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+PERMANENT_ERROR_CODES = {'content_filter', 'content_policy_violation', 'invalid_prompt'}
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed AOAI call is worth retrying and how long to wait before doing so.
+    """
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def classify(self, error):
+        """
+        Returns (retryable, reason) for an exception raised while calling the API or parsing its answer.
+        """
+        if isinstance(error, json.JSONDecodeError):
+            return False, 'malformed_json'
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True, 'connection_error'
+        code = getattr(error, 'code', None)
+        if code in PERMANENT_ERROR_CODES:
+            return False, code
+        status_code = getattr(error, 'status_code', None)
+        if status_code is None:
+            return True, type(error).__name__
+        if status_code in RETRYABLE_STATUS_CODES or status_code >= 500:
+            return True, f'http_{status_code}'
+        return False, f'http_{status_code}'
+
+    def retry_after(self, error):
+        """
+        Returns the delay in seconds the server asked for, or None.
+        """
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            value = headers.get('retry-after')
+            if value is None:
+                return None
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt, error=None):
+        """
+        Returns the delay before retry number `attempt` (0-based): exponential backoff with full
+        jitter, but never shorter than a Retry-After hint from the server.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = self.retry_after(error) if error is not None else None
+        if hint is not None:
+            delay = max(delay, hint)
+        return delay
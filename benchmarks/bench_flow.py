@@ -0,0 +1,255 @@
+"""Load test of the full annotation flow with N simulated annotators.
+
+Every annotator walks /prolific -> /save_prolific -> /save_design_tool ->
+/save_adobe_app -> POST /annotate for each item of its batch -> /end. With
+--api the items are fetched and submitted through the JSON API instead, the
+way the page does it when scripts run: prefetch item N+1, then submit item N. The run
+reports throughput and per-route latency percentiles, then checks that every
+annotator's batch was saved exactly once and that batch_count.json is balanced.
+
+By default the app runs in-process behind Flask's test client. With
+--gunicorn-workers the harness starts a local gunicorn instead and drives it
+over HTTP, which exercises the multi-process session and batch stores.
+
+    python benchmarks/bench_flow.py --rows 3000 --annotators 200 --concurrency 32
+    python benchmarks/bench_flow.py --gunicorn-workers 4 --annotators 200
+    python benchmarks/bench_flow.py --api
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from benchmarks.bench_render import percentile  # noqa: E402
+from benchmarks.synthetic import write_dataset  # noqa: E402
+from storage import read_batch_counts  # noqa: E402
+
+class TestClientDriver:
+    def __init__(self, annotation_app):
+        self.client = annotation_app.app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.headers.get('Location')
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.headers.get('Location')
+
+    def get_json(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_json()
+
+    def post_json(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_json()
+
+class HttpDriver:
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, allow_redirects=False)
+        return response.status_code, response.headers.get('Location')
+
+    def post(self, path, data):
+        response = self.session.post(self.base_url + path, data=data, allow_redirects=False)
+        return response.status_code, response.headers.get('Location')
+
+    def get_json(self, path):
+        response = self.session.get(self.base_url + path)
+        return response.status_code, response.json()
+
+    def post_json(self, path, data):
+        response = self.session.post(self.base_url + path, data=data)
+        return response.status_code, response.json()
+
+ANNOTATION_FORM = {
+    'background_color': 'aligned_well', 'title': 'aligned_well', 'author': 'aligned_well',
+    'tagline': 'aligned_well', 'explanation': 'load test',
+    **{f'rank_image_{i}_{j}': str(j) for i in range(1, 8) for j in range(1, 4)},
+}
+
+def simulate_annotator(driver, prolific_id, timings, api=False):
+    """Walk one participant through the study, recording (route, ms) pairs"""
+    def timed(route, call, *args):
+        start = time.perf_counter()
+        status, result = call(*args)
+        timings.append((route, (time.perf_counter() - start) * 1000))
+        if status >= 400:
+            raise RuntimeError(f"{route} returned {status} for {prolific_id}")
+        return status, result
+
+    timed('GET /prolific', driver.get, '/prolific')
+    timed('POST /save_prolific', driver.post, '/save_prolific', {'prolific_id': prolific_id})
+    timed('POST /save_design_tool', driver.post, '/save_design_tool', {'design_usage': 'sometimes'})
+    timed('POST /save_adobe_app', driver.post, '/save_adobe_app', {'adobe_app': 'express'})
+    submitted = 0
+    if api:
+        # The first item comes with the server-rendered page, the rest through the API
+        timed('GET /annotate', driver.get, '/annotate')
+        position, total = 0, None
+        while total is None or position < total:
+            _, payload = timed('GET /api/items', driver.get_json, f'/api/items?start={position + 1}&count=1')
+            _, result = timed('POST /api/annotations', driver.post_json, '/api/annotations',
+                              {**ANNOTATION_FORM, 'position': position})
+            if not result['accepted']:
+                raise RuntimeError(f"Submission {position} of {prolific_id} was not accepted: {result}")
+            position, total = result['index'], result['total']
+            submitted += 1
+        timed('GET /end', driver.get, '/end')
+        return submitted
+    while True:
+        status, location = timed('GET /annotate', driver.get, '/annotate')
+        if status == 302 and location and location.endswith('/end'):
+            break
+        timed('POST /annotate', driver.post, '/annotate', ANNOTATION_FORM)
+        submitted += 1
+    timed('GET /end', driver.get, '/end')
+    return submitted
+
+def check_results(expected_submissions):
+    """Compare the saved annotations and batch counts with what the annotators submitted"""
+    problems = []
+    saved = defaultdict(list)
+    for path in glob.glob(os.path.join('responses', '*.jsonl')):
+        with open(path, 'r') as file:
+            for line in file:
+                record = json.loads(line)
+                saved[record['prolific_id']].append(record)
+
+    for prolific_id, submitted in expected_submissions.items():
+        records = saved.get(prolific_id, [])
+        qids = Counter(record['qid'] for record in records)
+        duplicates = [qid for qid, count in qids.items() if count > 1]
+        if duplicates:
+            problems.append(f"{prolific_id}: duplicate annotations for qids {duplicates}")
+        if len(records) != submitted:
+            problems.append(f"{prolific_id}: {submitted} submitted, {len(records)} saved")
+        elif records and set(qids) != set(records[0]['user_batch_ids']):
+            problems.append(f"{prolific_id}: saved qids do not match the assigned batch")
+
+    counts, _ = read_batch_counts('batch_count.json')
+    if max(counts.values()) - min(counts.values()) > 1:
+        problems.append(f"batch_count.json is unbalanced: min {min(counts.values())}, max {max(counts.values())}")
+    if sum(counts.values()) != len(expected_submissions):
+        problems.append(f"batch_count.json counts {sum(counts.values())} assignments for {len(expected_submissions)} annotators")
+    return problems
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@contextlib.contextmanager
+def gunicorn_server(workers):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+         '--chdir', os.getcwd(), "app:create_app(image_proxy=False, log_level='WARNING')"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        # SIGTERM lets the workers flush their annotation sinks
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+
+def run_load(make_driver, annotators, concurrency, api=False):
+    timings, submissions, lock = [], {}, threading.Lock()
+
+    def one(i):
+        prolific_id = f'load{i:05d}'
+        local_timings = []
+        submitted = simulate_annotator(make_driver(), prolific_id, local_timings, api)
+        with lock:
+            timings.extend(local_timings)
+            submissions[prolific_id] = submitted
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(one, i) for i in range(annotators)]:
+            future.result()
+    return timings, submissions, time.perf_counter() - start
+
+def report(timings, submissions, elapsed):
+    print(f"{len(submissions)} annotators, {sum(submissions.values())} annotations, {len(timings)} requests "
+          f"in {elapsed:.1f}s ({len(timings) / elapsed:.0f} req/s)")
+    by_route = defaultdict(list)
+    for route, ms in timings:
+        by_route[route].append(ms)
+    print(f"{'route':<24} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, samples in by_route.items():
+        print(f"{route:<24} {len(samples):>7} {percentile(samples, 50):>8.2f} "
+              f"{percentile(samples, 95):>8.2f} {percentile(samples, 99):>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the annotation web flow')
+    parser.add_argument('--rows', type=int, default=1050, help='Synthetic dataset size')
+    parser.add_argument('--annotators', type=int, default=100, help='Simulated annotators')
+    parser.add_argument('--concurrency', type=int, default=16, help='Annotators active at the same time')
+    parser.add_argument('--gunicorn-workers', type=int, default=0, help='Run a local gunicorn with this many workers instead of the test client')
+    parser.add_argument('--api', action='store_true', help='Fetch and submit items through the JSON API instead of the form')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory with responses and state')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_flow_')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        write_dataset('data_with_gpt.jsonl', args.rows)
+        if args.gunicorn_workers:
+            with gunicorn_server(args.gunicorn_workers) as base_url:
+                timings, submissions, elapsed = run_load(lambda: HttpDriver(base_url), args.annotators, args.concurrency,
+                                                         args.api)
+        else:
+            import app as annotation_app
+            with contextlib.redirect_stdout(io.StringIO()):
+                annotation_app.init_app(trial_mode=False, image_proxy=False, log_level='WARNING')
+                timings, submissions, elapsed = run_load(lambda: TestClientDriver(annotation_app),
+                                                         args.annotators, args.concurrency, args.api)
+                annotation_app.annotation_sink.close()
+                annotation_app.metrics.close()
+
+        report(timings, submissions, elapsed)
+        problems = check_results(submissions)
+        for problem in problems:
+            print(f"FAIL {problem}")
+        print("Correctness checks passed" if not problems else f"{len(problems)} correctness problems")
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Working directory: {work_dir}")
+        else:
+            import shutil
+            shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Per-request latency of GET /annotate as the dataset grows.
+
+Compares the old linear scan over `data` with the ID index built in init_app,
+both for the lookup alone and for a full page render through the test client.
+
+    python benchmarks/bench_lookup.py --sizes 1000 10000 100000
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as annotation_app  # noqa: E402
+from benchmarks.synthetic import load_source_records, write_dataset  # noqa: E402
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def bench_size(num_rows, repeat, source):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            write_dataset('data_with_gpt.jsonl', num_rows, source)
+            with contextlib.redirect_stdout(io.StringIO()):
+                annotation_app.init_app(trial_mode=False, log_level='WARNING')
+                client = annotation_app.app.test_client()
+                client.post('/save_prolific', data={'prolific_id': 'bench'})
+
+            # The old lookup scanned a list holding every decoded record
+            data = list(annotation_app.data)
+            # Look up the item stored last, the worst case for the scan
+            target = data[-1]['ID']
+            scan_ms = time_per_call(lambda: next(item for item in data if item['ID'] == target), repeat)
+            index_ms = time_per_call(lambda: annotation_app.data_by_id[target], repeat)
+            with contextlib.redirect_stdout(io.StringIO()):
+                render_ms = time_per_call(lambda: client.get('/annotate'), repeat)
+            # Flush while the working directory still exists
+            annotation_app.annotation_sink.close()
+            annotation_app.metrics.close()
+        finally:
+            os.chdir(cwd)
+    return scan_ms, index_ms, render_ms
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark task lookup in the annotate route')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Dataset sizes in rows')
+    parser.add_argument('--repeat', type=int, default=50, help='Requests per measurement')
+    args = parser.parse_args()
+
+    source = load_source_records()
+    print(f"{'rows':>8} {'scan ms':>10} {'index ms':>10} {'GET /annotate ms':>18}")
+    for num_rows in args.sizes:
+        scan_ms, index_ms, render_ms = bench_size(num_rows, args.repeat, source)
+        print(f"{num_rows:>8} {scan_ms:>10.3f} {index_ms:>10.5f} {render_ms:>18.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""GET /annotate latency under concurrent load, with and without the render cache.
+
+Each simulated annotator signs up, then alternates GET /annotate (timed) and
+POST /annotate (to move on to the next item) through its own test client.
+Later rounds hand out batches that earlier annotators already rendered, as
+happens once a study has more participants than batches.
+
+    python benchmarks/bench_render.py --rows 1050 --annotators 32 --rounds 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as annotation_app  # noqa: E402
+from benchmarks.synthetic import write_dataset  # noqa: E402
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+def annotator(worker_id, items, latencies, lock):
+    client = annotation_app.app.test_client()
+    client.post('/save_prolific', data={'prolific_id': f'bench{worker_id}'})
+    samples = []
+    for _ in range(items):
+        start = time.perf_counter()
+        response = client.get('/annotate')
+        samples.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            break
+        client.post('/annotate', data={'background_color': 'aligned_well'})
+    with lock:
+        latencies.extend(samples)
+
+def run(round_number, annotators, items):
+    latencies, lock = [], threading.Lock()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=annotators) as executor:
+        for i in range(annotators):
+            executor.submit(annotator, f'{round_number}-{i}', items, latencies, lock)
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark annotation page rendering under concurrent load')
+    parser.add_argument('--rows', type=int, default=1050, help='Synthetic dataset size')
+    parser.add_argument('--annotators', type=int, default=32, help='Concurrent simulated annotators per round')
+    parser.add_argument('--items', type=int, default=30, help='Items each annotator goes through')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds per configuration; batches repeat once every batch was handed out')
+    args = parser.parse_args()
+
+    print(f"{'render cache':>12} {'round':>6} {'requests':>9} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            write_dataset('data_with_gpt.jsonl', args.rows)
+            for label, size in (('off', 0), ('on', annotation_app.RENDER_CACHE_SIZE)):
+                for state_file in os.listdir('.'):
+                    if state_file.startswith('annotation_state') or state_file == 'batch_count.json':
+                        os.remove(state_file)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    annotation_app.init_app(trial_mode=False, image_proxy=False, render_cache_size=size, log_level='WARNING')
+                for round_number in range(1, args.rounds + 1):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        latencies, elapsed = run(round_number, args.annotators, args.items)
+                    print(f"{label:>12} {round_number:>6} {len(latencies):>9} {percentile(latencies, 50):>8.2f} "
+                          f"{percentile(latencies, 99):>8.2f} {len(latencies) / elapsed:>8.0f}")
+            annotation_app.annotation_sink.close()
+            annotation_app.metrics.close()
+        finally:
+            os.chdir(cwd)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""Synthetic datasets for the benchmarks, cloned from the real annotation data."""
+import json
+import os
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_JSONL = os.path.join(REPO_DIR, 'data_with_gpt.jsonl')
+
+def load_source_records():
+    with open(SOURCE_JSONL, 'r') as file:
+        return [json.loads(line) for line in file]
+
+def write_dataset(path, num_rows, source=None):
+    """Write `num_rows` records to `path`, cycling through the real records with fresh IDs"""
+    source = source or load_source_records()
+    with open(path, 'w') as file:
+        for i in range(num_rows):
+            record = dict(source[i % len(source)])
+            record['ID'] = i + 1
+            json.dump(record, file)
+            file.write('\n')
+    return path
@@ -0,0 +1,149 @@
+import json
+import os
+from typing import Dict, Optional
+
+from atomic_file import atomic_write
+from storage import ProgressStore
+
+FSYNC_EVERY = 20  # Default number of records between fsyncs
+
+def journal_path_for(output_file: str) -> str:
+    """Journal file that belongs to an output JSONL file"""
+    return os.path.splitext(output_file)[0] + '.checkpoint.jsonl'
+
+class JournalFile(ProgressStore):
+    """Progress kept in a JSONL journal next to the output file, one {"ID": ..., "offset": ...} line per task"""
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self.journal = None
+
+    def load(self) -> Dict[object, int]:
+        entries = {}
+        if not os.path.exists(self.journal_file):
+            return entries
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry['ID']] = entry['offset']
+                except (ValueError, KeyError, TypeError):
+                    break  # Torn write at the end of the journal
+        return entries
+
+    def record(self, task_id, offset: int):
+        if self.journal is None:
+            self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        json.dump({'ID': task_id, 'offset': offset}, self.journal)
+        self.journal.write('\n')
+
+    def replace(self, entries: Dict[object, int]):
+        """Compact: rewrite the journal atomically with one line per ID"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        with atomic_write(self.journal_file, encoding='utf-8') as f:
+            for task_id, offset in sorted(entries.items(), key=lambda item: item[1]):
+                json.dump({'ID': task_id, 'offset': offset}, f)
+                f.write('\n')
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def close(self):
+        self.sync()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+class CheckpointJournal:
+    """Append-only record of the tasks already written to an output JSONL file.
+
+    For every task the progress store keeps the size of the output file right
+    after that task's row was appended; by default it is a journal file next to
+    the output, but any storage.ProgressStore works. The output file is the
+    source of truth: on open, rows past the last recorded offset are rescanned, a
+    torn trailing row is cut off, and the store is compacted to one entry per ID.
+    The checkpoint therefore always matches the output file.
+    """
+    def __init__(self, output_file: str, journal_file: Optional[str] = None, fsync_every: int = FSYNC_EVERY,
+                 progress: Optional[ProgressStore] = None):
+        self.output_file = output_file
+        self.journal_file = journal_file or journal_path_for(output_file)
+        self.progress = progress if progress is not None else JournalFile(self.journal_file)
+        self.fsync_every = max(1, fsync_every)
+        self.completed: Dict[object, int] = {}
+        self.pending_sync = 0
+        self._recover()
+        self.output = open(self.output_file, 'a', encoding='utf-8')
+
+    def _recover(self):
+        """Rebuild the set of completed IDs from the progress store and the output file, then compact"""
+        entries = self.progress.load()
+        output_size = os.path.getsize(self.output_file) if os.path.exists(self.output_file) else 0
+        scan_from = max(entries.values(), default=0)
+        if scan_from > output_size or (scan_from and not self._ends_row(scan_from)):
+            print(f"Checkpoint of {self.output_file} does not match the file, rescanning")
+            entries, scan_from = {}, 0
+
+        if output_size > scan_from:
+            with open(self.output_file, 'rb') as f:
+                f.seek(scan_from)
+                offset = scan_from
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        task_id = json.loads(line)['ID']
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    offset += len(line)
+                    entries[task_id] = offset
+            if offset < output_size:
+                print(f"Truncating incomplete row at the end of {self.output_file}")
+                with open(self.output_file, 'r+b') as f:
+                    f.truncate(offset)
+
+        self.completed = entries
+        self.progress.replace(entries)
+
+    def _ends_row(self, offset: int) -> bool:
+        with open(self.output_file, 'rb') as f:
+            f.seek(offset - 1)
+            return f.read(1) == b'\n'
+
+    def __contains__(self, task_id) -> bool:
+        return task_id in self.completed
+
+    def __len__(self) -> int:
+        return len(self.completed)
+
+    def append(self, result: Dict):
+        """Append a result row to the output file and journal its ID"""
+        json.dump(result, self.output)
+        self.output.write('\n')
+        self.output.flush()
+        offset = self.output.tell()
+        self.completed[result['ID']] = offset
+        self.progress.record(result['ID'], offset)
+        self.pending_sync += 1
+        if self.pending_sync >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        """Make everything appended so far durable; the output file goes first"""
+        os.fsync(self.output.fileno())
+        self.progress.sync()
+        self.pending_sync = 0
+
+    def close(self):
+        self.sync()
+        self.output.close()
+        self.progress.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
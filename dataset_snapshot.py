@@ -0,0 +1,232 @@
+"""Precompiled, versioned snapshot of the annotation dataset.
+
+The build step reads the dataset JSONL once and writes a single binary file
+with every record, the ID index, the frozen batch layout and the list of image
+URLs. Workers memory-map the file and only decode records when they are
+asked for, so starting a worker costs milliseconds whatever the dataset size.
+The snapshot ID is a hash of the content and the batch layout, so rebuilding
+unchanged data gives the same ID. Batch counts and the state database record
+the ID they were produced for, and the app refuses to mix state from
+different snapshots.
+
+    python dataset_snapshot.py build --input data_with_gpt.jsonl --batch-size 30
+    python dataset_snapshot.py info data_with_gpt.snapshot
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+from collections import OrderedDict
+
+from atomic_file import atomic_write
+from image_cache import dataset_image_urls
+from jsonl_index import JsonlIndex, DECODED_CACHE_SIZE
+
+MAGIC = b'ANNSNAP\0'
+FORMAT_VERSION = 1  # Bumped whenever the layout below changes
+SNAPSHOT_EXT = '.snapshot'
+BATCH_SEED = 42  # Seed of the batch shuffle; gives the same layout the app produced before snapshots
+PREAMBLE = struct.Struct('<8sII')  # magic, format version, header length
+SECTIONS = ('ids', 'offsets', 'batch_starts', 'batch_members', 'image_urls', 'records')
+
+class SnapshotMismatch(RuntimeError):
+    """State on disk was produced for a different dataset snapshot"""
+
+def snapshot_path_for(jsonl_file):
+    return os.path.splitext(jsonl_file)[0] + SNAPSHOT_EXT
+
+def _padded(payload):
+    """Sections start at multiples of 8 so the integer arrays can be viewed in place"""
+    return payload + b'\0' * (-len(payload) % 8)
+
+def build_snapshot(jsonl_file, snapshot_file=None, batch_size=30, seed=BATCH_SEED):
+    """Compile a dataset JSONL file into a snapshot, atomically; returns the snapshot ID"""
+    snapshot_file = snapshot_file or snapshot_path_for(jsonl_file)
+    ids, offsets, records = array('q'), array('q', [0]), []
+    with open(jsonl_file, 'rb') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            ids.append(record['ID'])
+            records.append(line)
+            offsets.append(offsets[-1] + len(line))
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Error: {jsonl_file} has duplicate IDs.")
+
+    # A private generator, so the layout does not depend on who else used the global one
+    shuffled = list(ids)
+    random.Random(seed).shuffle(shuffled)
+    batch_starts = array('q', range(0, len(shuffled), batch_size))
+    batch_starts.append(len(shuffled))
+    image_urls = dataset_image_urls(json.loads(line) for line in records)
+
+    sections = {
+        'ids': ids.tobytes(),
+        'offsets': offsets.tobytes(),
+        'batch_starts': batch_starts.tobytes(),
+        'batch_members': array('q', shuffled).tobytes(),
+        'image_urls': json.dumps(image_urls).encode('utf-8'),
+        'records': b''.join(records),
+    }
+    digest = hashlib.sha256(json.dumps([FORMAT_VERSION, sys.byteorder, batch_size]).encode('utf-8'))
+    for name in SECTIONS:
+        digest.update(struct.pack('<Q', len(sections[name])))
+        digest.update(sections[name])
+    content_hash = digest.hexdigest()
+
+    source = os.stat(jsonl_file)
+    header = {
+        'snapshot_id': content_hash[:16],
+        'content_hash': content_hash,
+        'byteorder': sys.byteorder,
+        'source': os.path.basename(jsonl_file),
+        'source_size': source.st_size,
+        'source_mtime_ns': source.st_mtime_ns,
+        'records': len(ids),
+        'batches': len(batch_starts) - 1,
+        'batch_size': batch_size,
+        'seed': seed,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    # Offsets depend on the header length, which depends on the offsets; settle on a fixed point
+    header_bytes = b''
+    while True:
+        position = PREAMBLE.size + len(_padded(header_bytes))
+        header['sections'] = {}
+        for name in SECTIONS:
+            header['sections'][name] = [position, len(sections[name])]
+            position += len(_padded(sections[name]))
+        header['size'] = position
+        encoded = json.dumps(header).encode('utf-8')
+        if encoded == header_bytes:
+            break
+        header_bytes = encoded
+
+    with atomic_write(snapshot_file, 'wb') as file:
+        file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        file.write(_padded(header_bytes))
+        for name in SECTIONS:
+            file.write(_padded(sections[name]))
+    return header['snapshot_id']
+
+class DatasetSnapshot(JsonlIndex):
+    """ID-addressable view of a snapshot file, with the same interface as JsonlIndex.
+
+    `batches` is the frozen layout as [{'batch_id', 'batch_ids'}] and
+    `image_urls` every image URL of the dataset, both read without decoding
+    any record.
+    """
+    def __init__(self, path, cache_size=DECODED_CACHE_SIZE, transform=None):
+        self.path = path
+        self.key = 'ID'
+        self.cache_size = cache_size
+        self.transform = transform
+        self.cache = OrderedDict()
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = []
+        try:
+            self._read()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self):
+        if len(self.mm) < PREAMBLE.size:
+            raise ValueError(f"Error: {self.path} is not a dataset snapshot.")
+        magic, version, header_length = PREAMBLE.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"Error: {self.path} is not a dataset snapshot.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Error: {self.path} has snapshot format {version}, expected {FORMAT_VERSION}; rebuild it.")
+        self.header = json.loads(self.mm[PREAMBLE.size:PREAMBLE.size + header_length])
+        if self.header['size'] != len(self.mm):
+            raise ValueError(f"Error: {self.path} is truncated ({len(self.mm)} of {self.header['size']} bytes).")
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f"Error: {self.path} was built on a {self.header['byteorder']}-endian machine; rebuild it.")
+        self.snapshot_id = self.header['snapshot_id']
+        self.batch_size = self.header['batch_size']
+
+        self.ids = self._array('ids').tolist()
+        self.positions = dict(zip(self.ids, range(len(self.ids))))
+        self.offsets = self._array('offsets')
+        self.records_start = self.header['sections']['records'][0]
+        starts, members = self._array('batch_starts'), self._array('batch_members')
+        self.batches = [{'batch_id': i + 1, 'batch_ids': members[starts[i]:starts[i + 1]].tolist()}
+                        for i in range(len(starts) - 1)]
+        self.image_urls = json.loads(self._section('image_urls'))
+
+    def _section(self, name):
+        start, length = self.header['sections'][name]
+        return self.mm[start:start + length]
+
+    def _array(self, name):
+        start, length = self.header['sections'][name]
+        view = memoryview(self.mm)[start:start + length].cast('q')
+        self.views.append(view)
+        return view
+
+    def _decode(self, position):
+        start = self.records_start + self.offsets[position]
+        end = self.records_start + self.offsets[position + 1]
+        record = json.loads(self.mm[start:end])
+        return self.transform(record) if self.transform else record
+
+    def is_stale(self, jsonl_file):
+        """True if the source JSONL file changed since the snapshot was built"""
+        if not os.path.exists(jsonl_file):
+            return False
+        source = os.stat(jsonl_file)
+        return (source.st_size, source.st_mtime_ns) != (self.header['source_size'], self.header['source_mtime_ns'])
+
+    def verify(self):
+        """Recompute the content hash over the sections"""
+        digest = hashlib.sha256(json.dumps([FORMAT_VERSION, sys.byteorder, self.batch_size]).encode('utf-8'))
+        for name in SECTIONS:
+            section = self._section(name)
+            digest.update(struct.pack('<Q', len(section)))
+            digest.update(section)
+        return digest.hexdigest() == self.header['content_hash']
+
+    def close(self):
+        # The array views must be released before their memory map can be closed
+        for view in getattr(self, 'views', []):
+            view.release()
+        self.views = []
+        super().close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and inspect dataset snapshots')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Compile a dataset JSONL file into a snapshot')
+    build.add_argument('--input', default='data_with_gpt.jsonl', help='Dataset JSONL file')
+    build.add_argument('--output', default=None, help=f'Snapshot file (default: the input with {SNAPSHOT_EXT})')
+    build.add_argument('--batch-size', type=int, default=30, help='Items per batch; the app uses 30, or 5 in trial mode')
+    build.add_argument('--seed', type=int, default=BATCH_SEED, help='Seed of the batch shuffle')
+    info = subparsers.add_parser('info', help='Show the header of a snapshot and check its content hash')
+    info.add_argument('snapshot', help='Snapshot file')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        output = args.output or snapshot_path_for(args.input)
+        snapshot_id = build_snapshot(args.input, output, args.batch_size, args.seed)
+        print(f"Built {output} (snapshot {snapshot_id}) in {time.perf_counter() - start:.2f}s")
+    else:
+        start = time.perf_counter()
+        snapshot = DatasetSnapshot(args.snapshot)
+        load_time = time.perf_counter() - start
+        print(json.dumps({key: value for key, value in snapshot.header.items() if key != 'sections'}, indent=1))
+        print(f"Loaded in {load_time * 1000:.1f}ms; content hash {'OK' if snapshot.verify() else 'MISMATCH'}")
+        snapshot.close()
+
+if __name__ == '__main__':
+    main()
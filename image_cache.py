@@ -0,0 +1,264 @@
+"""Local content-addressed cache of the clipart shown on annotation pages.
+
+Originals are stored once under objects/ by the SHA-256 of their bytes, and
+urls/ maps the hash of each source URL to its object. Thumbnails are rendered
+on first request into thumbs/. Every file is written to a temporary name and
+renamed into place, so several workers can share one cache directory. Page
+requests never wait for a download: a miss is fetched in the background, and
+a URL that failed is left alone for a while.
+
+    python image_cache.py --input data_with_gpt.jsonl --workers 16
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import requests
+
+from atomic_file import atomic_write
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails fall back to the original image
+    Image = None
+
+IMAGE_CACHE_DIR = 'image_cache'
+THUMB_WIDTHS = (200, 400, 800)  # Widths the app is allowed to render
+DEFAULT_THUMB_WIDTH = 400
+FETCH_TIMEOUT = 20  # seconds
+PREFETCH_WORKERS = 8
+BACKGROUND_WORKERS = 2  # Downloads started by page requests that missed the cache, per process
+FAILURE_TTL = 300  # seconds a URL that failed to download is not tried again
+MODEL_IMAGE_SIDE = 768  # Longest side sent to the vision models; they downscale larger images anyway
+MODEL_IMAGE_QUALITY = 85  # JPEG quality of inlined images
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def dataset_image_urls(records):
+    """All image URLs referenced by the dataset, in order of first appearance"""
+    urls = {}
+    for record in records:
+        for image_set in record.get('images', []):
+            for url in image_set.get('urls', []):
+                urls.setdefault(url, None)
+    return list(urls)
+
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR, session=None, timeout=FETCH_TIMEOUT, failure_ttl=FAILURE_TTL):
+        self.directory = directory
+        self.timeout = timeout
+        self.failure_ttl = failure_ttl
+        self.local = threading.local()
+        self.session = session
+        self.lock = threading.Lock()
+        self.executor = None  # Started on the first background fetch, so it never crosses a fork
+        self.pending = set()  # URLs being downloaded in the background
+        self.failures = {}  # url -> time of the last failed download
+        for sub_dir in ('objects', 'urls', 'thumbs'):
+            os.makedirs(os.path.join(directory, sub_dir), exist_ok=True)
+
+    def http(self):
+        """Pooled HTTP session, one per thread unless one was injected"""
+        if self.session is not None:
+            return self.session
+        if getattr(self.local, 'session', None) is None:
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _write(self, path, payload):
+        with atomic_write(path, 'wb') as file:
+            file.write(payload)
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        """Content hash of a cached URL, or None"""
+        try:
+            with open(os.path.join(self.directory, 'urls', url_key(url)), 'r') as file:
+                return json.load(file)['sha256']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def cached(self, url):
+        """Content hash of `url` if its image is on disk, without touching the network"""
+        digest = self.lookup(url)
+        if digest is not None and os.path.exists(self.object_path(digest)):
+            return digest
+        return None
+
+    def fetch(self, url):
+        """Content hash of the image at `url`, downloading it if it is not cached yet"""
+        digest = self.cached(url)
+        if digest is not None:
+            return digest
+        response = self.http().get(url, timeout=self.timeout)
+        response.raise_for_status()
+        payload = response.content
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, payload)
+        meta = {'url': url, 'sha256': digest, 'content_type': response.headers.get('Content-Type')}
+        self._write(os.path.join(self.directory, 'urls', url_key(url)), json.dumps(meta).encode('utf-8'))
+        return digest
+
+    def read(self, digest):
+        with open(self.object_path(digest), 'rb') as file:
+            return file.read()
+
+    def thumbnail(self, digest, width):
+        """PNG thumbnail of a cached image at most `width` pixels wide, as (bytes, mimetype)"""
+        if Image is None:
+            return self.read(digest), 'application/octet-stream'
+        path = os.path.join(self.directory, 'thumbs', f'{digest}_{width}.png')
+        if not os.path.exists(path):
+            with Image.open(io.BytesIO(self.read(digest))) as image:
+                image.thumbnail((width, width * 4))
+                buffer = io.BytesIO()
+                if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    image = image.convert('RGBA')
+                image.save(buffer, format='PNG', optimize=True)
+            self._write(path, buffer.getvalue())
+        with open(path, 'rb') as file:
+            return file.read(), 'image/png'
+
+    def fetch_later(self, url, widths=(DEFAULT_THUMB_WIDTH,)):
+        """Download `url` and render its thumbnails in the background, unless that is already
+        under way or the URL failed less than `failure_ttl` seconds ago"""
+        with self.lock:
+            failed_at = self.failures.get(url)
+            if url in self.pending or (failed_at is not None and time.time() - failed_at < self.failure_ttl):
+                return
+            self.pending.add(url)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='image-fetch')
+        self.executor.submit(self._fetch_later, url, widths)
+
+    def _fetch_later(self, url, widths):
+        try:
+            digest = self.fetch(url)
+            for width in widths:
+                self.thumbnail(digest, width)
+            failed = False
+        except Exception as e:
+            logging.getLogger(__name__).warning("Failed to fetch %s: %s", url, e)
+            failed = True
+        with self.lock:
+            self.pending.discard(url)
+            if failed:
+                self.failures[url] = time.time()
+            else:
+                self.failures.pop(url, None)
+
+    def prefetch(self, urls, workers=PREFETCH_WORKERS, widths=(DEFAULT_THUMB_WIDTH,)):
+        """Download every URL and render its thumbnails; returns the URLs that failed"""
+        def fetch_one(url):
+            try:
+                digest = self.fetch(url)
+                for width in widths:
+                    self.thumbnail(digest, width)
+                return None
+            except Exception as e:
+                return url, e
+
+        failures = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for done, failure in enumerate(executor.map(fetch_one, urls), start=1):
+                if failure is not None:
+                    failures.append(failure)
+                    print(f"Failed to fetch {failure[0]}: {failure[1]}")
+                if done % 100 == 0:
+                    print(f"Fetched {done}/{len(urls)} images")
+        return failures
+
+class InlineImageEncoder:
+    """Turns image URLs into base64 data URLs sized for the vision models.
+
+    Each URL is downloaded once through the image cache, and the downscaled
+    payload is memoized by content hash, so clipart shared between briefs is
+    encoded once per run even when several threads ask for it at the same time.
+    """
+    def __init__(self, image_cache, max_side=MODEL_IMAGE_SIDE, quality=MODEL_IMAGE_QUALITY):
+        self.image_cache = image_cache
+        self.max_side = max_side
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.by_url = {}  # url -> Future of the data URL
+        self.by_digest = {}  # content hash -> data URL
+        self.encoded = 0
+
+    def data_url(self, url):
+        """Data URL for an image; falls back to the remote URL if it cannot be fetched"""
+        with self.lock:
+            future = self.by_url.get(url)
+            owner = future is None
+            if owner:
+                future = self.by_url[url] = Future()
+        if owner:
+            try:
+                future.set_result(self._encode(url))
+            except Exception as e:
+                print(f"Sending remote URL for {url}: {e}")
+                with self.lock:
+                    del self.by_url[url]  # Let a later attempt try again
+                future.set_result(url)
+        return future.result()
+
+    def _encode(self, url):
+        digest = self.image_cache.fetch(url)
+        with self.lock:
+            if digest in self.by_digest:
+                return self.by_digest[digest]
+        payload, mimetype = self._downscale(self.image_cache.read(digest))
+        encoded = f"data:{mimetype};base64,{base64.b64encode(payload).decode('ascii')}"
+        with self.lock:
+            self.encoded += 1
+            return self.by_digest.setdefault(digest, encoded)
+
+    def _downscale(self, payload):
+        if Image is None:
+            return payload, 'image/png'
+        with Image.open(io.BytesIO(payload)) as image:
+            image.thumbnail((self.max_side, self.max_side))
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Clipart is mostly transparent; flatten it onto white rather than JPEG's black
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+        return buffer.getvalue(), 'image/jpeg'
+
+    def stats(self):
+        with self.lock:
+            return {'urls': len(self.by_url), 'encoded': self.encoded}
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefetch dataset images into the local image cache')
+    parser.add_argument('--input', default='data_with_gpt.jsonl', help='Dataset JSONL whose images[*].urls are fetched')
+    parser.add_argument('--cache-dir', default=IMAGE_CACHE_DIR, help='Image cache directory')
+    parser.add_argument('--workers', type=int, default=PREFETCH_WORKERS, help='Concurrent downloads')
+    parser.add_argument('--widths', type=int, nargs='+', default=[DEFAULT_THUMB_WIDTH], help='Thumbnail widths to render')
+    args = parser.parse_args()
+
+    with open(args.input, 'r') as file:
+        urls = dataset_image_urls(json.loads(line) for line in file if line.strip())
+    print(f"Prefetching {len(urls)} images into {args.cache_dir}")
+    failures = ImageCache(args.cache_dir).prefetch(urls, workers=args.workers, widths=args.widths)
+    print(f"Done: {len(urls) - len(failures)} cached, {len(failures)} failed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Metrics and logging for the annotation app.
+
+Counters and histograms live in each worker process. A background thread in
+every worker writes its values to <directory>/<pid>.json once they change, at
+most every SNAPSHOT_INTERVAL seconds, and /metrics sums those snapshots
+with the serving worker's live values, so a scrape sees the whole gunicorn
+server whichever worker answers it. Gauges are computed at scrape time.
+"""
+import atexit
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from atomic_file import atomic_write
+
+METRICS_DIR = 'annotation_metrics'  # Per-worker snapshots merged by /metrics
+SNAPSHOT_INTERVAL = 5.0  # seconds between a worker's snapshot writes
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+LOG_RATE_LIMIT = 20  # records per call site and interval before repeats are dropped
+LOG_RATE_INTERVAL = 60.0  # seconds
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.values = {}  # label key -> total
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.registry.lock:
+            self.registry._touch()
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values, other):
+        for key, total in other.items():
+            values[key] = values.get(key, 0) + total
+
+    def samples(self, values):
+        for key, total in sorted(values.items()):
+            yield self.name, key, (), total
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key -> per-bucket counts (last one is +Inf), then sum
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.registry.lock:
+            self.registry._touch()
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merge(self, values, other):
+        for key, state in other.items():
+            mine = values.setdefault(key, [0] * len(state[:-1]) + [0.0])
+            for i, value in enumerate(state):
+                mine[i] += value
+
+    def samples(self, values):
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield f'{self.name}_sum', key, (), state[-1]
+            yield f'{self.name}_count', key, (), cumulative
+
+class Gauge:
+    """Value read at scrape time from `collect`, which returns a number or a list of (labels dict, number)"""
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, collect):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def samples(self, values):
+        value = self.collect()
+        if isinstance(value, list):
+            for labels, number in value:
+                yield self.name, _label_key(labels), (), number
+        else:
+            yield self.name, (), (), value
+
+class MetricsRegistry:
+    def __init__(self, directory=METRICS_DIR, snapshot_interval=SNAPSHOT_INTERVAL):
+        # Absolute, so the final snapshot at exit lands in the same place whatever the working directory is then
+        self.directory = os.path.abspath(directory) if directory else None
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.RLock()
+        self.metrics = {}
+        self.pid = os.getpid()
+        self.dirty = False
+        self.writer = None
+        self.closed = False
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._drop_dead_snapshots()
+            atexit.register(self.close)
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(self, name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, buckets))
+
+    def gauge(self, name, documentation, collect):
+        return self._register(Gauge(self, name, documentation, collect))
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # A forked worker starts from zero; the parent's values are in the parent's snapshot
+            self.pid = os.getpid()
+            self.writer = None
+            for metric in self.metrics.values():
+                if hasattr(metric, 'values'):
+                    metric.values = {}
+
+    def _touch(self):
+        """Mark values as changed and make sure this process has a snapshot writer; called under the lock"""
+        self._check_fork()
+        self.dirty = True
+        if self.directory and self.writer is None and not self.closed:
+            self.writer = threading.Thread(target=self._run_writer, name='MetricsSnapshot', daemon=True)
+            self.writer.start()
+
+    def _run_writer(self):
+        pid = os.getpid()
+        while not self.closed and self.pid == pid:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.snapshot()
+            except OSError as e:
+                logging.getLogger(__name__).warning("Could not write metrics snapshot: %s", e)
+
+    def _drop_dead_snapshots(self):
+        """Forget workers of earlier runs so their totals are not carried into this one"""
+        for name in os.listdir(self.directory):
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, name))
+            except PermissionError:
+                pass
+
+    def _local_values(self):
+        with self.lock:
+            self._check_fork()
+            return {name: {key: list(value) if isinstance(value, list) else value
+                           for key, value in metric.values.items()}
+                    for name, metric in self.metrics.items() if hasattr(metric, 'values')}
+
+    def snapshot(self):
+        """Write this worker's values for the other workers' /metrics if they changed since the last write"""
+        if not self.directory:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        payload = {name: [[list(map(list, key)), value] for key, value in values.items()]
+                   for name, values in self._local_values().items()}
+        # Rewritten constantly and worthless after a crash, so not fsynced
+        with atomic_write(os.path.join(self.directory, f'{self.pid}.json'), fsync=False) as file:
+            json.dump(payload, file)
+
+    def close(self):
+        if self.closed or self.pid != os.getpid():
+            return
+        self.closed = True
+        self.snapshot()
+
+    def _merged_values(self):
+        merged = self._local_values()
+        if not self.directory:
+            return merged
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == f'{self.pid}.json':
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r') as file:
+                    snapshot = json.load(file)
+            except (FileNotFoundError, ValueError):
+                continue
+            for metric_name, entries in snapshot.items():
+                metric = self.metrics.get(metric_name)
+                if metric is None or not hasattr(metric, 'merge'):
+                    continue
+                metric.merge(merged.setdefault(metric_name, {}),
+                             {tuple(map(tuple, key)): value for key, value in entries})
+        return merged
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        values = self._merged_values()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            try:
+                for sample_name, key, extra, value in metric.samples(values.get(name, {})):
+                    lines.append(f'{sample_name}{_format_labels(key, extra)} {_format_value(value)}')
+            except Exception as e:
+                logging.getLogger(__name__).warning("Could not collect %s: %s", name, e)
+        return '\n'.join(lines) + '\n'
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limit` records per call site and interval, then reports how many were dropped"""
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = {}  # (logger, level, message template) -> [window start, emitted, suppressed]
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+def configure_logging(name, level=logging.INFO):
+    """Leveled, rate-limited logger writing to stderr; safe to call again on re-initialization"""
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    return logger
@@ -0,0 +1,91 @@
+import json
+import mmap
+import os
+import re
+from array import array
+from collections import OrderedDict
+
+DECODED_CACHE_SIZE = 256  # Default number of decoded records kept per index
+ID_PREFIX = re.compile(rb'\{\s*"ID"\s*:\s*(-?\d+)\s*[,}]')  # Rows written by json.dump start with the ID
+
+class JsonlIndex:
+    """Read-only, ID-addressable view of a JSONL file.
+
+    Only the byte offset of each row is kept in memory; rows are decoded on
+    demand from a read-only memory map, so worker processes share the file's
+    pages through the OS page cache instead of each holding a copy of every
+    record. Iteration yields records in file order. `transform`, if given, is
+    applied to every record as it is decoded.
+    """
+    def __init__(self, path, key='ID', cache_size=DECODED_CACHE_SIZE, transform=None):
+        self.path = path
+        self.key = key
+        self.cache_size = cache_size
+        self.transform = transform
+        self.cache = OrderedDict()
+        self.ids = []
+        self.offsets = array('q')
+        self.positions = {}
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._build(size)
+
+    def _build(self, size):
+        start = 0
+        while start < size:
+            end = self.mm.find(b'\n', start)
+            if end == -1:
+                end = size
+            if end > start and not self.mm[start:end].isspace():
+                match = ID_PREFIX.match(self.mm, start, end) if self.key == 'ID' else None
+                record_id = int(match.group(1)) if match else json.loads(self.mm[start:end])[self.key]
+                self.positions[record_id] = len(self.ids)
+                self.ids.append(record_id)
+                self.offsets.append(start)
+            start = end + 1
+
+    def _decode(self, position):
+        start = self.offsets[position]
+        end = self.mm.find(b'\n', start)
+        if end == -1:
+            end = len(self.mm)
+        record = json.loads(self.mm[start:end])
+        return self.transform(record) if self.transform else record
+
+    def get(self, record_id, default=None):
+        """Decoded record for an ID; recently used records are kept decoded"""
+        if record_id in self.cache:
+            self.cache.move_to_end(record_id)
+            return self.cache[record_id]
+        position = self.positions.get(record_id)
+        if position is None:
+            return default
+        record = self._decode(position)
+        if self.cache_size:
+            self.cache[record_id] = record
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return record
+
+    def __getitem__(self, record_id):
+        record = self.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def __contains__(self, record_id):
+        return record_id in self.positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """Records in file order, decoded one at a time and not cached"""
+        for position in range(len(self.ids)):
+            yield self._decode(position)
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.file.close()
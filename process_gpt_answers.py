@@ -1,52 +1,86 @@
 import json
-from azure_openai.aoai_gpt import AoaiGptInterface
+from azure_openai.aoai_gpt import AoaiGptInterface, DeploymentPool, TokenBucket, DEFAULT_CONFIG_LABEL
+from azure_openai.retry_policy import RetryPolicy
+from azure_openai.response_cache import ResponseCache, cache_key, DEFAULT_CACHE_FILE, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE_DAYS
+from checkpoint_journal import CheckpointJournal, FSYNC_EVERY
+from storage import open_storage
+from jsonl_index import JsonlIndex
+from image_cache import ImageCache, InlineImageEncoder, IMAGE_CACHE_DIR, MODEL_IMAGE_SIDE
+from run_telemetry import RunTelemetry, RUN_LOG_FILE, SUMMARY_INTERVAL, response_usage
 import time
 import argparse
+import contextlib
 import os
-from typing import List, Dict, Any
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional
 
 # Configuration
+INPUT_FILE = 'data.jsonl'
 MAX_RETRIES = 3  # Default max retry attempts
-DELAY_BETWEEN_RETRIES = 5  # seconds
-CHECKPOINT_FILE = 'gpt_processing_checkpoint.json'
-
-def load_checkpoint() -> Dict[int, Any]:
-    """Load checkpoint of completed tasks"""
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_checkpoint(completed_tasks: Dict[int, Any]):
-    """Save checkpoint of completed tasks"""
-    with open(CHECKPOINT_FILE, 'w') as f:
-        json.dump(completed_tasks, f)
-
-def save_task_result(task_id: int, result: Dict, output_file: str):
-    """Save individual task result to output file"""
-    with open(output_file, 'a') as f:
-        json.dump(result, f)
-        f.write('\n')
-
-def generate_gpt_answer(gpt_interface, task, max_retries: int = MAX_RETRIES) -> Dict:
-    """Generate GPT answer for a single task with retry logic"""
-    for attempt in range(max_retries):
-        try:
-            # Modified system prompt to be more neutral
-            messages = [
-                {"role": "system", "content": """You are a design consultant helping to analyze design requirements and visual elements. Your task is to:
+DELAY_BETWEEN_RETRIES = 5  # seconds, base of the exponential backoff
+LEGACY_CHECKPOINT_FILE = 'gpt_processing_checkpoint.json'  # Superseded by the per-output checkpoint, migrated on start
+DEAD_LETTER_FILE = 'gpt_dead_letter.jsonl'  # tasks that failed for good, see --rerun-dead-letter
+CONCURRENCY = 1  # Default number of tasks in flight
+REQUESTS_PER_SECOND = 1.0  # Default sustained request rate per deployment
+BURST = 1  # Default number of requests a deployment may send back to back
+SUBMIT_WINDOW = 4  # Tasks queued per worker ahead of completion
+COMPARISON_OUTPUT_FILE = 'data_with_gpt_models.jsonl'  # One row per task with the answers of every compared model
+
+dead_letter_lock = threading.Lock()
+
+def save_dead_letter(task, error: Exception, reason: str, attempts: int, model: Optional[str] = None):
+    """Record a task that could not be processed so it can be re-run later"""
+    entry = {
+        'ID': task['ID'],
+        **({'model': model} if model else {}),
+        'reason': reason,
+        'error': str(error),
+        'attempts': attempts,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with dead_letter_lock:
+        with open(DEAD_LETTER_FILE, 'a') as f:
+            json.dump(entry, f)
+            f.write('\n')
+
+def load_dead_letter_ids() -> set:
+    """Load the IDs recorded in the dead-letter file"""
+    if not os.path.exists(DEAD_LETTER_FILE):
+        return set()
+    with open(DEAD_LETTER_FILE, 'r') as f:
+        return {json.loads(line)['ID'] for line in f if line.strip()}
+
+def migrate_legacy_checkpoint(completed_tasks: CheckpointJournal):
+    """Retire the old {ID: true} checkpoint file once every ID in it is covered by the output file"""
+    with open(LEGACY_CHECKPOINT_FILE, 'r') as f:
+        legacy_ids = json.load(f)
+    # Rows were written before the old checkpoint was updated, so IDs missing from the output were never saved
+    missing = [task_id for task_id in legacy_ids if int(task_id) not in completed_tasks]
+    if missing:
+        print(f"{len(missing)} tasks in {LEGACY_CHECKPOINT_FILE} have no row in {completed_tasks.output_file} "
+              f"and will be processed again: {missing[:10]}")
+    os.replace(LEGACY_CHECKPOINT_FILE, f"{LEGACY_CHECKPOINT_FILE}.migrated")
+    print(f"Migrated {LEGACY_CHECKPOINT_FILE}; progress is now tracked with {completed_tasks.output_file}")
+
+def build_messages(task, image_encoder: Optional[InlineImageEncoder] = None) -> List[Dict]:
+    """Build the chat messages for a single task; images are inlined if an encoder is given"""
+    # Modified system prompt to be more neutral
+    messages = [
+        {"role": "system", "content": """You are a design consultant helping to analyze design requirements and visual elements. Your task is to:
 1. Review the design brief and reference images
 2. Suggest appropriate design elements
 3. Provide confidence levels for suggestions
 4. Note areas needing additional review
 5. Structure response in JSON format"""},
-            ]
+    ]
 
-            # Simplified user prompt to avoid content policy issues
-            user_content = [
-                {
-                    "type": "text",
-                    "text": f"""Please review this design brief and the reference images:
+    # Simplified user prompt to avoid content policy issues
+    user_content = [
+        {
+            "type": "text",
+            "text": f"""Please review this design brief and the reference images:
 
 Brief: {task['user_query']}
 
@@ -58,90 +92,430 @@ Provide your analysis in this JSON format:
     "review_points": ["areas needing additional review"],
     "overall_confidence": "low/medium/high"
 }}"""
-                }
-            ]
-
-            # Add images
-            for image_set in task['images']:
-                for url in image_set['urls']:
-                    user_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": url}
-                    })
-
-            messages.append({"role": "user", "content": user_content})
-
-            # Removed temperature parameter as it's not supported
-            response = gpt_interface.client.chat.completions.create(
-                model=gpt_interface.deployment_name,
-                messages=messages,
-                seed=42
-            )
-            return json.loads(response.choices[0].message.content)
+        }
+    ]
+
+    # Add images
+    for image_set in task['images']:
+        for url in image_set['urls']:
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": image_encoder.data_url(url) if image_encoder else url}
+            })
+
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+def messages_cache_key(deployment_name: str, messages: List[Dict]) -> str:
+    """Cache key for a request: deployment, system prompt, user prompt and image URLs"""
+    user_content = messages[1]['content']
+    image_urls = [part['image_url']['url'] for part in user_content if part['type'] == 'image_url']
+    return cache_key(deployment_name, messages[0]['content'], user_content[0]['text'], image_urls)
+
+def generate_gpt_answer(deployment_pool: DeploymentPool, task, max_retries: int = MAX_RETRIES,
+                        rate_limiter: Optional[TokenBucket] = None,
+                        retry_policy: Optional[RetryPolicy] = None,
+                        response_cache: Optional[ResponseCache] = None,
+                        image_encoder: Optional[InlineImageEncoder] = None,
+                        telemetry: Optional[RunTelemetry] = None, model: Optional[str] = None) -> Dict:
+    """Generate GPT answer for a single task with retry logic; None if it failed for good"""
+    if retry_policy is None:
+        retry_policy = RetryPolicy(base_delay=DELAY_BETWEEN_RETRIES)
+    task_start = time.monotonic()
+    key_messages = build_messages(task)
+    name = f"task {task['ID']}" + (f" on {model}" if model else "")
+
+    def finish(outcome, attempts, answer=None):
+        if telemetry is not None:
+            telemetry.record_task(task['ID'], outcome, attempts, time.monotonic() - task_start, model=model)
+        return answer
+
+    if response_cache is not None:
+        content = response_cache.get_any([messages_cache_key(deployment_name, key_messages)
+                                          for deployment_name in deployment_pool.deployment_names()])
+        if content is not None:
+            return finish('cached', 0, json.loads(content))
+
+    messages = build_messages(task, image_encoder) if image_encoder else key_messages
+    payload_bytes = len(json.dumps(messages)) if telemetry is not None else 0
+
+    for attempt in range(max_retries):
+        delay = None
+        try:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+
+            deployment = deployment_pool.acquire()
+            start = time.monotonic()
+            try:
+                # Removed temperature parameter as it's not supported
+                response = deployment.client.chat.completions.create(
+                    model=deployment.deployment_name,
+                    messages=messages,
+                    seed=42
+                )
+            except Exception as e:
+                latency = time.monotonic() - start
+                status_code = getattr(e, 'status_code', None)
+                delay = retry_policy.backoff(attempt, e)
+                deployment_pool.release(deployment, status_code=status_code, retry_after=retry_policy.retry_after(e),
+                                        backoff=delay)
+                if telemetry is not None:
+                    telemetry.record_call(task['ID'], deployment.label, deployment.deployment_name, attempt + 1,
+                                          latency, payload_bytes, status=status_code, error=retry_policy.classify(e)[1])
+                raise
+            latency = time.monotonic() - start
+            deployment_pool.release(deployment, latency=latency)
+            if telemetry is not None:
+                telemetry.record_call(task['ID'], deployment.label, deployment.deployment_name, attempt + 1,
+                                      latency, payload_bytes, usage=response_usage(response))
+            content = response.choices[0].message.content
+            answer = json.loads(content)
+            if response_cache is not None:
+                response_cache.put(messages_cache_key(deployment.deployment_name, key_messages), content,
+                                   deployment.deployment_name)
+            return finish('ok', attempt + 1, answer)
         
         except Exception as e:
+            retryable, reason = retry_policy.classify(e)
+            if not retryable:
+                print(f"Permanent error on {name} ({reason}): {e}")
+                save_dead_letter(task, e, reason, attempt + 1, model)
+                return finish('failed', attempt + 1)
             if attempt < max_retries - 1:
-                print(f"Error on task {task['ID']} (attempt {attempt + 1}/{max_retries}): {e}")
-                print(f"Retrying in {DELAY_BETWEEN_RETRIES} seconds...")
-                time.sleep(DELAY_BETWEEN_RETRIES)
+                if delay is None:
+                    delay = retry_policy.backoff(attempt, e)
+                print(f"Error on {name} (attempt {attempt + 1}/{max_retries}): {e}")
+                print(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
             else:
-                print(f"Failed to process task {task['ID']} after {max_retries} attempts: {e}")
-                return None
+                print(f"Failed to process {name} after {max_retries} attempts: {e}")
+                save_dead_letter(task, e, reason, max_retries, model)
+                return finish('failed', max_retries)
 
-def process_data(trial_mode: bool = False, max_retries: int = MAX_RETRIES):
-    """Process data with trial mode and checkpointing support"""
-    # Initialize GPT interface
-    gpt_interface = AoaiGptInterface()
-    gpt_interface.select_config()
+def select_task_ids(tasks: JsonlIndex, trial_mode: bool, rerun_dead_letter: bool) -> List:
+    """IDs of the input tasks this run covers, in file order"""
+    task_ids = list(tasks.ids)
 
-    # Load original data
-    with open('data.jsonl', 'r') as f:
-        tasks = [json.loads(line) for line in f]
-
-    # Load checkpoint
-    completed_tasks = load_checkpoint()
-    
     # In trial mode, process enough tasks to make complete batches
     if trial_mode:
         batch_size = 5  # smaller batch size for trial
         num_tasks = batch_size * 2  # process 2 complete batches
-        tasks = tasks[:num_tasks]
-        print(f"Trial mode: Processing first {len(tasks)} tasks")
+        task_ids = task_ids[:num_tasks]
+        print(f"Trial mode: Processing first {len(task_ids)} tasks")
+
+    if rerun_dead_letter:
+        dead_ids = load_dead_letter_ids()
+        task_ids = [task_id for task_id in task_ids if task_id in dead_ids]
+        if os.path.exists(DEAD_LETTER_FILE):
+            # Keep the previous failures around; this run records its own
+            os.replace(DEAD_LETTER_FILE, f"{DEAD_LETTER_FILE}.prev")
+        print(f"Re-running {len(task_ids)} tasks from {DEAD_LETTER_FILE}")
+    return task_ids
+
+def print_run_report(telemetry: RunTelemetry, deployment_pools: List[DeploymentPool], run_log: Optional[str],
+                     response_cache: Optional[ResponseCache], image_encoder: Optional[InlineImageEncoder]):
+    """Final summary: totals, per-deployment traffic and latency, cache hit counts"""
+    print(telemetry.summary_line())
+    tokens = telemetry.summary()['tokens']
+    print(f"Tokens: {tokens.get('prompt_tokens', 0)} prompt, {tokens.get('completion_tokens', 0)} completion, "
+          f"{tokens.get('total_tokens', 0)} total")
+    call_stats = {stats['deployment']: stats for stats in telemetry.deployment_stats()}
+    for deployment_pool in deployment_pools:
+        for stats in deployment_pool.stats():
+            calls = call_stats.get(stats['label'], {})
+            latency = (f"avg latency {stats['avg_latency']:.2f}s, p95 {calls['p95_latency']:.2f}s"
+                       if stats['avg_latency'] is not None and calls.get('p95_latency') is not None else "no completed requests")
+            print(f"Deployment {stats['label']}: {stats['requests']} requests, {stats['throttled']} throttled, "
+                  f"{stats['server_errors']} server errors, {calls.get('total_tokens', 0)} tokens, {latency}")
+    if run_log:
+        print(f"Run log: {run_log} (run {telemetry.run_id})")
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        print(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        response_cache.close()
+    if image_encoder is not None:
+        image_stats = image_encoder.stats()
+        print(f"Inlined images: {image_stats['encoded']} encoded for {image_stats['urls']} unique URLs")
+
+def process_data(trial_mode: bool = False, max_retries: int = MAX_RETRIES,
+                 concurrency: int = CONCURRENCY, rate: float = REQUESTS_PER_SECOND, burst: int = BURST,
+                 config_labels: List[str] = DEFAULT_CONFIG_LABEL, rerun_dead_letter: bool = False,
+                 fsync_every: int = FSYNC_EVERY, cache_file: Optional[str] = DEFAULT_CACHE_FILE,
+                 cache_max_bytes: int = DEFAULT_MAX_BYTES, cache_max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+                 inline_images: bool = True, image_side: int = MODEL_IMAGE_SIDE,
+                 run_log: Optional[str] = RUN_LOG_FILE, summary_interval: float = SUMMARY_INTERVAL,
+                 progress_db: Optional[str] = None):
+    """Process data with trial mode and checkpointing support"""
+    # Initialize GPT interface
+    gpt_interface = AoaiGptInterface(config_labels)
+    # Every deployment is paced by its own bucket, so each label's quota adds to the throughput
+    deployment_pool = DeploymentPool(gpt_interface, rate=rate, burst=burst)
+    response_cache = ResponseCache(cache_file, cache_max_bytes, cache_max_age_days) if cache_file else None
+    image_encoder = InlineImageEncoder(ImageCache(IMAGE_CACHE_DIR), max_side=image_side) if inline_images else None
+
+    # Index original data; tasks are decoded only when they are submitted
+    tasks = JsonlIndex(INPUT_FILE, cache_size=0)
+    task_ids = select_task_ids(tasks, trial_mode, rerun_dead_letter)
 
     output_file = 'data_with_gpt_trial.jsonl' if trial_mode else 'data_with_gpt.jsonl'
-    
-    # Process each task
-    for task in tasks:
-        task_id = task['ID']
-        
-        # Skip if already completed
-        if str(task_id) in completed_tasks:
-            print(f"Skipping task {task_id} (already completed)")
-            continue
 
-        print(f"Processing task {task_id}...")
-        gpt_answer = generate_gpt_answer(gpt_interface, task, max_retries)
-        
-        if gpt_answer:
-            task['gpt_answer'] = gpt_answer
-            # Save individual result
-            save_task_result(task_id, task, output_file)
-            # Update checkpoint
-            completed_tasks[str(task_id)] = True
-            save_checkpoint(completed_tasks)
-            print(f"Successfully processed task {task_id}")
-        else:
-            print(f"Skipping task {task_id} due to failure")
-        
-        time.sleep(1)  # Rate limiting
+    # Load checkpoint; completion is derived from the rows already in the output file
+    progress = open_storage(progress_db).progress(output_file) if progress_db else None
+    completed_tasks = CheckpointJournal(output_file, fsync_every=fsync_every, progress=progress)
+    if os.path.exists(LEGACY_CHECKPOINT_FILE) and not trial_mode:
+        migrate_legacy_checkpoint(completed_tasks)
+
+    pending = [task_id for task_id in task_ids if task_id not in completed_tasks]
+    if len(pending) < len(task_ids):
+        print(f"Skipping {len(task_ids) - len(pending)} tasks (already completed)")
+
+    telemetry = RunTelemetry(run_log, total=len(pending), summary_interval=summary_interval, config={
+        'input': INPUT_FILE, 'output': output_file, 'labels': list(config_labels), 'concurrency': concurrency,
+        'rate': rate, 'burst': burst, 'max_retries': max_retries, 'inline_images': inline_images,
+        'image_side': image_side, 'cache': bool(cache_file)})
+    print(f"Processing {len(pending)} tasks with concurrency {concurrency} at {rate} requests/sec per deployment over {len(deployment_pool.deployments)} deployments")
+    # Only a window of tasks is decoded and queued at a time, so memory does not grow with the dataset
+    window = max(1, concurrency) * SUBMIT_WINDOW
+    pending = iter(pending)
+    with completed_tasks, ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {}
+        while True:
+            for task_id in pending:
+                task = tasks[task_id]
+                futures[executor.submit(generate_gpt_answer, deployment_pool, task, max_retries,
+                                        response_cache=response_cache, image_encoder=image_encoder,
+                                        telemetry=telemetry)] = task
+                if len(futures) >= window:
+                    break
+            if not futures:
+                break
+
+            done, _ = wait(futures, timeout=summary_interval, return_when=FIRST_COMPLETED)
+            telemetry.maybe_print_summary()
+            for future in done:
+                task = futures.pop(future)
+                task_id = task['ID']
+                gpt_answer = future.result()
+
+                if gpt_answer:
+                    task['gpt_answer'] = gpt_answer
+                    # Save individual result and update checkpoint
+                    completed_tasks.append(task)
+                else:
+                    print(f"Skipping task {task_id} due to failure")
+    tasks.close()
+    telemetry.close()
 
     print(f"Processing complete. Results saved to {output_file}")
     print(f"Processed {len(completed_tasks)} tasks in total")
+    print_run_report(telemetry, [deployment_pool], run_log, response_cache, image_encoder)
+
+def parse_models(specs: List[str]) -> Dict[str, List[str]]:
+    """Model specs on the command line: a config label, or NAME=LABEL[,LABEL...] to pool several deployments"""
+    models = {}
+    for spec in specs:
+        name, _, labels = spec.partition('=')
+        labels = labels.split(',') if labels else [name]
+        if name in models:
+            raise ValueError(f"Error: Model {name} is given more than once.")
+        models[name] = [label for label in labels if label]
+    return models
+
+def parse_model_rates(specs: List[str]) -> Dict[str, float]:
+    """NAME=RATE pairs overriding the request rate of single models"""
+    rates = {}
+    for spec in specs:
+        name, _, rate = spec.partition('=')
+        try:
+            rates[name] = float(rate)
+        except ValueError:
+            raise ValueError(f"Error: Invalid model rate {spec!r}, expected NAME=RATE.")
+    return rates
+
+def model_output_file(output_file: str, model: str) -> str:
+    """Per-model checkpointed answers that belong to a comparison output file"""
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}.{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}{ext}"
+
+class ModelRun:
+    """Deployments, rate limit, workers and checkpoint of one model in a comparison run.
+
+    Answers are appended to the model's own output file as {"ID", "model",
+    "gpt_answer"} rows, so each model resumes independently of the others.
+    """
+    def __init__(self, name: str, labels: List[str], output_file: str, rate: float, burst: int,
+                 concurrency: int, fsync_every: int = FSYNC_EVERY, progress=None):
+        self.name = name
+        self.labels = labels
+        self.rate = rate
+        self.deployment_pool = DeploymentPool(AoaiGptInterface(labels), rate=rate, burst=burst)
+        self.completed = CheckpointJournal(output_file, fsync_every=fsync_every, progress=progress)
+        # Answers of earlier runs; opened after the journal has cut off any torn row
+        self.previous = JsonlIndex(output_file, cache_size=0)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix=f"model-{name}")
+        self.answered = 0
+        self.failed = 0
+
+    def previous_answer(self, task_id) -> Dict:
+        return self.previous[task_id]['gpt_answer']
+
+    def save(self, task_id, answer: Dict):
+        self.completed.append({'ID': task_id, 'model': self.name, 'gpt_answer': answer})
+        self.answered += 1
+
+    def close(self):
+        self.executor.shutdown()
+        self.completed.close()
+        self.previous.close()
+
+def compare_models(models: Dict[str, List[str]], trial_mode: bool = False, max_retries: int = MAX_RETRIES,
+                   concurrency: int = CONCURRENCY, rate: float = REQUESTS_PER_SECOND, burst: int = BURST,
+                   model_rates: Optional[Dict[str, float]] = None, rerun_dead_letter: bool = False,
+                   fsync_every: int = FSYNC_EVERY, cache_file: Optional[str] = DEFAULT_CACHE_FILE,
+                   cache_max_bytes: int = DEFAULT_MAX_BYTES, cache_max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+                   inline_images: bool = True, image_side: int = MODEL_IMAGE_SIDE,
+                   run_log: Optional[str] = RUN_LOG_FILE, summary_interval: float = SUMMARY_INTERVAL,
+                   progress_db: Optional[str] = None):
+    """Answer every task with each of `models` (name -> config labels); one row per task holds all their answers"""
+    model_rates = model_rates or {}
+    unknown = set(model_rates) - set(models)
+    if unknown:
+        raise ValueError(f"Error: Rates given for unknown models: {sorted(unknown)}")
+    response_cache = ResponseCache(cache_file, cache_max_bytes, cache_max_age_days) if cache_file else None
+    image_encoder = InlineImageEncoder(ImageCache(IMAGE_CACHE_DIR), max_side=image_side) if inline_images else None
+
+    tasks = JsonlIndex(INPUT_FILE, cache_size=0)
+    task_ids = select_task_ids(tasks, trial_mode, rerun_dead_letter)
+
+    output_file = COMPARISON_OUTPUT_FILE.replace('.jsonl', '_trial.jsonl') if trial_mode else COMPARISON_OUTPUT_FILE
+    storage = open_storage(progress_db) if progress_db else None
+    completed_tasks = CheckpointJournal(output_file, fsync_every=fsync_every,
+                                        progress=storage.progress(output_file) if storage else None)
+    runs: Dict[str, ModelRun] = {}
+    for name, labels in models.items():
+        run_file = model_output_file(output_file, name)
+        runs[name] = ModelRun(name, labels, run_file, model_rates.get(name, rate), burst, concurrency, fsync_every,
+                              progress=storage.progress(run_file) if storage else None)
+    primary = next(iter(runs))
+
+    pending = [task_id for task_id in task_ids if task_id not in completed_tasks]
+    if len(pending) < len(task_ids):
+        print(f"Skipping {len(task_ids) - len(pending)} tasks (already answered by every model)")
+    jobs = sum(task_id not in run.completed for task_id in pending for run in runs.values())
+
+    telemetry = RunTelemetry(run_log, total=jobs, summary_interval=summary_interval, config={
+        'input': INPUT_FILE, 'output': output_file, 'models': models,
+        'rates': {name: run.rate for name, run in runs.items()}, 'concurrency': concurrency, 'burst': burst,
+        'max_retries': max_retries, 'inline_images': inline_images, 'image_side': image_side,
+        'cache': bool(cache_file)})
+    print(f"Comparing {len(runs)} models on {len(pending)} tasks ({jobs} requests to make), "
+          f"concurrency {concurrency} per model")
+    for run in runs.values():
+        print(f"Model {run.name}: labels {', '.join(run.labels)}, {run.rate} requests/sec per deployment, "
+              f"{len(run.completed)} answers from earlier runs")
+
+    def merge(task, answers):
+        if len(answers) == len(runs):
+            task['gpt_answers'] = {name: answers[name] for name in runs}
+            task['gpt_answer'] = answers[primary]
+            completed_tasks.append(task)
+
+    window = max(1, concurrency) * SUBMIT_WINDOW
+    pending = iter(pending)
+    in_flight = {}  # task ID -> [task, answers by model, models still answering]
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(completed_tasks)
+        for run in runs.values():
+            stack.callback(run.close)
+        futures = {}
+        while True:
+            for task_id in pending:
+                task = tasks[task_id]
+                answers, waiting = {}, 0
+                for run in runs.values():
+                    if task_id in run.completed:
+                        answers[run.name] = run.previous_answer(task_id)
+                        continue
+                    futures[run.executor.submit(generate_gpt_answer, run.deployment_pool, task, max_retries,
+                                                response_cache=response_cache,
+                                                image_encoder=image_encoder, telemetry=telemetry,
+                                                model=run.name)] = (task_id, run)
+                    waiting += 1
+                if not waiting:
+                    # Every model answered in earlier runs; only the combined row was missing
+                    merge(task, answers)
+                    continue
+                in_flight[task_id] = [task, answers, waiting]
+                if len(in_flight) >= window:
+                    break
+            if not futures:
+                break
+
+            done, _ = wait(futures, timeout=summary_interval, return_when=FIRST_COMPLETED)
+            telemetry.maybe_print_summary()
+            for future in done:
+                task_id, run = futures.pop(future)
+                entry = in_flight[task_id]
+                gpt_answer = future.result()
+                if gpt_answer:
+                    run.save(task_id, gpt_answer)
+                    entry[1][run.name] = gpt_answer
+                else:
+                    run.failed += 1
+                entry[2] -= 1
+                if not entry[2]:
+                    del in_flight[task_id]
+                    merge(entry[0], entry[1])
+    tasks.close()
+    telemetry.close()
+
+    print(f"Comparison complete. Results saved to {output_file}")
+    print(f"{len(completed_tasks)} tasks answered by every model in total")
+    for run in runs.values():
+        print(f"Model {run.name}: {run.answered} answered, {run.failed} failed this run, "
+              f"{len(run.completed)} in total ({run.completed.output_file})")
+    print_run_report(telemetry, [run.deployment_pool for run in runs.values()], run_log, response_cache, image_encoder)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process data with GPT answers')
     parser.add_argument('--trial', action='store_true', help='Run in trial mode (process only 10 tasks)')
     parser.add_argument('--max-retries', type=int, default=MAX_RETRIES, help='Maximum number of retry attempts per task')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Number of tasks processed concurrently')
+    parser.add_argument('--rate', type=float, default=REQUESTS_PER_SECOND, help='Maximum API requests per second to each deployment (0 disables the limit); `rate = N` in a config section overrides it')
+    parser.add_argument('--burst', type=int, default=BURST, help='Number of API requests a deployment may receive back to back before rate limiting applies')
+    parser.add_argument('--labels', nargs='+', default=DEFAULT_CONFIG_LABEL, help='Configuration labels from config.ini to spread requests across')
+    parser.add_argument('--fsync-every', type=int, default=FSYNC_EVERY, help='Number of results between fsyncs of the output file and checkpoint journal')
+    parser.add_argument('--cache-file', default=DEFAULT_CACHE_FILE, help='SQLite file for cached model answers')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the API, bypassing the response cache')
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_MAX_BYTES / 1024 / 1024, help='Size of the response cache before least recently used answers are evicted')
+    parser.add_argument('--cache-max-age-days', type=float, default=DEFAULT_MAX_AGE_DAYS, help='Age after which cached answers are no longer used')
+    parser.add_argument('--remote-image-urls', action='store_true', help='Send the source image URLs instead of inlined, downscaled images')
+    parser.add_argument('--image-side', type=int, default=MODEL_IMAGE_SIDE, help='Longest side in pixels of inlined images')
+    parser.add_argument('--rerun-dead-letter', action='store_true', help=f'Only process the tasks recorded in {DEAD_LETTER_FILE}')
+    parser.add_argument('--run-log', default=RUN_LOG_FILE, help='JSONL file that every API call and task outcome is appended to')
+    parser.add_argument('--no-run-log', action='store_true', help='Do not write the run log')
+    parser.add_argument('--summary-every', type=float, default=SUMMARY_INTERVAL, help='Seconds between progress summaries')
+    parser.add_argument('--progress-db', default=None, help='Checkpoint progress in this SQLite state database instead of a journal file')
+    parser.add_argument('--models', nargs='+', default=None, help=f'Compare models in one pass: config labels, or NAME=LABEL[,LABEL...] to pool deployments; answers go to {COMPARISON_OUTPUT_FILE}')
+    parser.add_argument('--model-rate', nargs='+', default=[], help='NAME=RATE request rates per deployment of single models in --models runs (default --rate)')
     args = parser.parse_args()
 
-    process_data(trial_mode=args.trial, max_retries=args.max_retries) 
\ No newline at end of file
+    if args.models:
+        compare_models(parse_models(args.models), trial_mode=args.trial, max_retries=args.max_retries,
+                       concurrency=args.concurrency, rate=args.rate, burst=args.burst,
+                       model_rates=parse_model_rates(args.model_rate), rerun_dead_letter=args.rerun_dead_letter,
+                       fsync_every=args.fsync_every, cache_file=None if args.no_cache else args.cache_file,
+                       cache_max_bytes=int(args.cache_max_mb * 1024 * 1024), cache_max_age_days=args.cache_max_age_days,
+                       inline_images=not args.remote_image_urls, image_side=args.image_side,
+                       run_log=None if args.no_run_log else args.run_log, summary_interval=args.summary_every,
+                       progress_db=args.progress_db)
+    else:
+        process_data(trial_mode=args.trial, max_retries=args.max_retries,
+                     concurrency=args.concurrency, rate=args.rate, burst=args.burst,
+                     config_labels=args.labels, rerun_dead_letter=args.rerun_dead_letter,
+                     fsync_every=args.fsync_every, cache_file=None if args.no_cache else args.cache_file,
+                     cache_max_bytes=int(args.cache_max_mb * 1024 * 1024), cache_max_age_days=args.cache_max_age_days,
+                     inline_images=not args.remote_image_urls, image_side=args.image_side,
+                     run_log=None if args.no_run_log else args.run_log, summary_interval=args.summary_every,
+                     progress_db=args.progress_db) 
\ No newline at end of file
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque, defaultdict
+from typing import Dict, List, Optional
+
+RUN_LOG_FILE = 'gpt_run_log.jsonl'  # One JSON event per line, appended across runs
+SUMMARY_INTERVAL = 10.0  # Default seconds between live summary lines
+LATENCY_WINDOW = 1000  # Recent calls the live latency percentiles are taken over
+TOKEN_WINDOW = 60.0  # seconds of calls the live tokens/min is taken over
+MIN_RATE_SECONDS = 10.0  # tokens/min is not reported before the run is this old; a few calls say nothing about a minute
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile, None without samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+def response_usage(response) -> Dict[str, int]:
+    """Token counts reported by a chat completion; zeros if the response has none"""
+    usage = getattr(response, 'usage', None)
+    return {name: int(getattr(usage, name, 0) or 0) for name in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return 'n/a'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class RunTelemetry:
+    """Structured log and running totals of one GPT processing run.
+
+    Every API call and every finished task is appended to `log_file` as one JSON
+    event tagged with the run ID, so several runs can share a log. The live
+    summary reports progress over the whole run, and latency and tokens/min
+    over the most recent calls, which is what quota limits apply to.
+    """
+    def __init__(self, log_file: Optional[str] = RUN_LOG_FILE, total: int = 0,
+                 summary_interval: float = SUMMARY_INTERVAL, config: Optional[Dict] = None):
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.total = total
+        self.summary_interval = summary_interval
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_summary = self.started
+        self.tasks = defaultdict(int)  # outcome -> tasks
+        self.calls = 0
+        self.retries = 0
+        self.tokens = defaultdict(int)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.recent_tokens = deque()  # (monotonic time, total tokens) of the last TOKEN_WINDOW seconds
+        self.by_deployment: Dict[str, Dict] = {}
+        self.log = open(log_file, 'a', encoding='utf-8', buffering=1) if log_file else None
+        self._write({'event': 'run_start', 'total': total, 'config': config or {}})
+
+    def _write(self, event: Dict):
+        line = json.dumps({'run_id': self.run_id, 'time': round(time.time(), 3), **event}) + '\n'
+        with self.lock:
+            if self.log is not None:
+                self.log.write(line)
+
+    def record_call(self, task_id, deployment: str, engine: str, attempt: int, latency: float, payload_bytes: int,
+                    usage: Optional[Dict[str, int]] = None, status: Optional[int] = 200, error: Optional[str] = None):
+        """One API request, successful or not; `deployment` is the config label and `attempt` counts from 1"""
+        usage = usage or {}
+        now = time.monotonic()
+        with self.lock:
+            self.calls += 1
+            self.retries += attempt > 1
+            for name, count in usage.items():
+                self.tokens[name] += count
+            self.latencies.append(latency)
+            self.recent_tokens.append((now, usage.get('total_tokens', 0)))
+            stats = self.by_deployment.setdefault(deployment, {'calls': 0, 'errors': 0, 'total_tokens': 0, 'latencies': []})
+            stats['calls'] += 1
+            stats['errors'] += error is not None
+            stats['total_tokens'] += usage.get('total_tokens', 0)
+            stats['latencies'].append(latency)
+        self._write({'event': 'call', 'ID': task_id, 'deployment': deployment, 'engine': engine, 'attempt': attempt,
+                     'latency': round(latency, 4), 'payload_bytes': payload_bytes, 'status': status,
+                     'error': error, **usage})
+
+    def record_task(self, task_id, outcome: str, attempts: int, elapsed: float, model: Optional[str] = None):
+        """A finished task; outcome is 'ok', 'cached' or 'failed', `model` is set in model comparison runs"""
+        with self.lock:
+            self.tasks[outcome] += 1
+        self._write({'event': 'task', 'ID': task_id, 'outcome': outcome, 'attempts': attempts,
+                     'elapsed': round(elapsed, 4), **({'model': model} if model else {})})
+
+    def summary(self) -> Dict:
+        now = time.monotonic()
+        with self.lock:
+            while self.recent_tokens and now - self.recent_tokens[0][0] > TOKEN_WINDOW:
+                self.recent_tokens.popleft()
+            done = sum(self.tasks.values())
+            elapsed = now - self.started
+            rate = done / elapsed if elapsed > 0 else 0.0
+            # Until a full window has passed, scale the tokens seen so far to a minute
+            window = min(TOKEN_WINDOW, elapsed)
+            recent_tokens = sum(tokens for _, tokens in self.recent_tokens)
+            return {
+                'done': done,
+                'total': self.total,
+                'tasks': dict(self.tasks),
+                'calls': self.calls,
+                'retries': self.retries,
+                'elapsed': elapsed,
+                'tasks_per_sec': rate,
+                'eta': (self.total - done) / rate if rate > 0 and self.total >= done else None,
+                'p50_latency': percentile(list(self.latencies), 50),
+                'p95_latency': percentile(list(self.latencies), 95),
+                'tokens_per_min': recent_tokens * 60 / window if elapsed >= MIN_RATE_SECONDS else None,
+                'tokens': dict(self.tokens),
+            }
+
+    def summary_line(self) -> str:
+        s = self.summary()
+        p95 = f"{s['p95_latency']:.2f}s" if s['p95_latency'] is not None else 'n/a'
+        tokens_per_min = f"{s['tokens_per_min']:.0f}" if s['tokens_per_min'] is not None else 'n/a'
+        return (f"[{s['done']}/{s['total']}] {s['tasks_per_sec']:.2f} tasks/s, ETA {format_duration(s['eta'])}, "
+                f"p95 latency {p95}, {tokens_per_min} tokens/min, {s['retries']} retries, "
+                f"{s['tasks'].get('failed', 0)} failed")
+
+    def maybe_print_summary(self):
+        """Print the live summary if `summary_interval` seconds passed since the last one"""
+        now = time.monotonic()
+        if now - self.last_summary >= self.summary_interval:
+            self.last_summary = now
+            print(self.summary_line())
+
+    def deployment_stats(self) -> List[Dict]:
+        with self.lock:
+            return [{'deployment': name, 'calls': stats['calls'], 'errors': stats['errors'],
+                     'total_tokens': stats['total_tokens'],
+                     'p50_latency': percentile(stats['latencies'], 50),
+                     'p95_latency': percentile(stats['latencies'], 95)}
+                    for name, stats in self.by_deployment.items()]
+
+    def close(self):
+        summary = self.summary()
+        self._write({'event': 'run_end', **{k: v for k, v in summary.items() if k != 'eta'},
+                     'deployments': self.deployment_stats()})
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
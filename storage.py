@@ -0,0 +1,583 @@
+"""Shared state of a study: sessions, batch assignments, annotations and GPT progress.
+
+open_storage() returns a bundle of stores behind one interface. The default is
+a SQLite database in WAL mode that every worker process opens; 'memory' keeps
+everything in the current process, for tests and throwaway runs. Writes that
+belong together run in one IMMEDIATE transaction, so no state file is ever
+rewritten wholesale and concurrent workers cannot lose each other's updates.
+
+    python storage.py migrate --batch-counts batch_count.json --responses responses
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from atomic_file import atomic_write
+from annotation_sink import SQLiteAnnotationSink, MemoryAnnotationSink, create_annotations_table, insert_annotations
+
+STATE_DB = 'annotation_state.db'  # Shared by all worker processes
+MEMORY = 'memory'  # open_storage() spec of the in-process implementation
+SESSION_TTL = 6 * 3600  # seconds of inactivity before a session is dropped
+SESSION_CLEANUP_INTERVAL = 300  # seconds between TTL cleanup passes
+LEASE_SECONDS = 3600  # seconds a batch stays reserved for a participant without activity
+IMPORT_BATCH = 500  # annotation rows per transaction when migrating response files
+SNAPSHOT_META_KEY = 'dataset_snapshot'  # meta entry naming the dataset snapshot the batches belong to
+
+class SQLiteDatabase:
+    """One SQLite connection per thread and process, in WAL mode so workers can share the file"""
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            # Connections must not cross a fork, so gunicorn workers open their own
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def transaction(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+def read_batch_counts(path):
+    """Counts of a batch_count.json file and the dataset snapshot they belong to (None for files from before snapshots)"""
+    with open(path, 'r') as file:
+        payload = json.load(file)
+    if 'counts' in payload:
+        return payload['counts'], payload.get('snapshot')
+    return payload, None
+
+def write_batch_counts(path, batch_counts, snapshot_id=None):
+    """Write batch counts atomically, stamped with the dataset snapshot whose batch layout they count"""
+    payload = {'snapshot': snapshot_id, 'counts': batch_counts} if snapshot_id else batch_counts
+    with atomic_write(path) as file:
+        json.dump(payload, file)
+
+class SessionStore:
+    """Per-participant session data keyed by the session key held in the signed cookie"""
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.last_cleanup = 0.0
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def save(self, key, data):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Drop sessions that have been inactive for longer than the TTL; returns how many"""
+        raise NotImplementedError
+
+    def count_active(self):
+        raise NotImplementedError
+
+    def _maybe_cleanup(self, now):
+        if now - self.last_cleanup > SESSION_CLEANUP_INTERVAL:
+            self.cleanup()
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, db, ttl=SESSION_TTL):
+        super().__init__(ttl)
+        self.db = db
+        self.db.connect().execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' key TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+
+    def get(self, key):
+        row = self.db.connect().execute(
+            'SELECT data FROM sessions WHERE key = ? AND updated_at >= ?', (key, time.time() - self.ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key, data):
+        now = time.time()
+        self.db.connect().execute(
+            'INSERT OR REPLACE INTO sessions (key, data, updated_at) VALUES (?, ?, ?)',
+            (key, json.dumps(data), now)
+        )
+        self._maybe_cleanup(now)
+
+    def delete(self, key):
+        self.db.connect().execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def cleanup(self):
+        self.last_cleanup = time.time()
+        cursor = self.db.connect().execute('DELETE FROM sessions WHERE updated_at < ?', (self.last_cleanup - self.ttl,))
+        return cursor.rowcount
+
+    def count_active(self):
+        return self.db.connect().execute(
+            'SELECT COUNT(*) FROM sessions WHERE updated_at >= ?', (time.time() - self.ttl,)
+        ).fetchone()[0]
+
+class MemorySessionStore(SessionStore):
+    """Sessions are stored serialized, so callers never share a dict with the store"""
+    def __init__(self, ttl=SESSION_TTL):
+        super().__init__(ttl)
+        self.sessions = {}  # key -> (JSON data, updated_at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.sessions.get(key)
+        return json.loads(entry[0]) if entry and entry[1] >= time.time() - self.ttl else None
+
+    def save(self, key, data):
+        now = time.time()
+        with self.lock:
+            self.sessions[key] = (json.dumps(data), now)
+        self._maybe_cleanup(now)
+
+    def delete(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+    def cleanup(self):
+        self.last_cleanup = time.time()
+        with self.lock:
+            expired = [key for key, (_, updated_at) in self.sessions.items() if updated_at < self.last_cleanup - self.ttl]
+            for key in expired:
+                del self.sessions[key]
+        return len(expired)
+
+    def count_active(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            return sum(updated_at >= cutoff for _, updated_at in self.sessions.values())
+
+class BatchAllocator:
+    """Hands out the least loaded batch under a lease that expires unless the participant finishes.
+
+    A batch's load is its completed count plus its active leases; ties go to the
+    lowest batch ID. A session that already holds a lease keeps its batch.
+    """
+    def __init__(self, lease_seconds=LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+
+    def seed(self, batch_counts):
+        """Add batches that are not known yet, counting their existing assignments as completed"""
+        raise NotImplementedError
+
+    def assign(self, session_id):
+        """Lease the least loaded batch to a session and return its ID"""
+        raise NotImplementedError
+
+    def renew(self, session_id, batch_id=None):
+        """Extend an active lease while the participant is still working; an expired lease is taken out
+        again on `batch_id`, the batch the session was given"""
+        raise NotImplementedError
+
+    def complete(self, session_id, batch_id=None):
+        """Turn the session's lease into a completed assignment; if the lease expired, the completion is
+        counted on `batch_id` instead. Returns False if nothing was counted"""
+        raise NotImplementedError
+
+    def counts(self):
+        """Assignments per batch as {str(batch_id): completed + active leases}"""
+        raise NotImplementedError
+
+    def export_counts(self, path, snapshot_id=None):
+        """Write the current counts to a batch_count.json style file, atomically"""
+        write_batch_counts(path, self.counts(), snapshot_id)
+
+class SQLiteBatchAllocator(BatchAllocator):
+    """The expression index on the load makes the batches table a priority queue, and every
+    assignment runs in one IMMEDIATE transaction, so concurrent sign-ups never race for a slot."""
+    def __init__(self, db, lease_seconds=LEASE_SECONDS):
+        super().__init__(lease_seconds)
+        self.db = db
+        conn = self.db.connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS batches ('
+            ' batch_id INTEGER PRIMARY KEY, completed INTEGER NOT NULL DEFAULT 0, leased INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS batches_load ON batches (completed + leased, batch_id)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            ' session_id TEXT PRIMARY KEY, batch_id INTEGER NOT NULL, expires_at REAL NOT NULL,'
+            ' completed INTEGER NOT NULL DEFAULT 0)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS leases_expiry ON leases (completed, expires_at)')
+
+    def transaction(self):
+        return self.db.transaction()
+
+    def seed(self, batch_counts):
+        conn = self.transaction()
+        try:
+            conn.executemany(
+                'INSERT OR IGNORE INTO batches (batch_id, completed) VALUES (?, ?)',
+                [(int(batch_id), count) for batch_id, count in batch_counts.items()]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _expire(self, conn, now):
+        expired = conn.execute(
+            'SELECT batch_id, COUNT(*) FROM leases WHERE completed = 0 AND expires_at < ? GROUP BY batch_id', (now,)
+        ).fetchall()
+        conn.executemany('UPDATE batches SET leased = leased - ? WHERE batch_id = ?',
+                         [(count, batch_id) for batch_id, count in expired])
+        conn.execute('DELETE FROM leases WHERE completed = 0 AND expires_at < ?', (now,))
+
+    def assign(self, session_id):
+        now = time.time()
+        conn = self.transaction()
+        try:
+            self._expire(conn, now)
+            row = conn.execute(
+                'SELECT batch_id FROM leases WHERE session_id = ? AND completed = 0', (session_id,)
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    'SELECT batch_id FROM batches ORDER BY completed + leased, batch_id LIMIT 1'
+                ).fetchone()
+                if row is None:
+                    raise ValueError("No batches available for assignment")
+                conn.execute('UPDATE batches SET leased = leased + 1 WHERE batch_id = ?', (row[0],))
+            conn.execute(
+                'INSERT OR REPLACE INTO leases (session_id, batch_id, expires_at) VALUES (?, ?, ?)',
+                (session_id, row[0], now + self.lease_seconds)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return row[0]
+
+    def renew(self, session_id, batch_id=None):
+        expires_at = time.time() + self.lease_seconds
+        renewed = self.db.connect().execute(
+            'UPDATE leases SET expires_at = ? WHERE session_id = ? AND completed = 0', (expires_at, session_id)
+        ).rowcount
+        if renewed or batch_id is None:
+            return
+        conn = self.transaction()
+        try:
+            # The lease expired while the participant was still working; take it out again on the same batch
+            if conn.execute('SELECT 1 FROM leases WHERE session_id = ?', (session_id,)).fetchone() is None:
+                if conn.execute('UPDATE batches SET leased = leased + 1 WHERE batch_id = ?', (int(batch_id),)).rowcount:
+                    conn.execute('INSERT INTO leases (session_id, batch_id, expires_at) VALUES (?, ?, ?)',
+                                 (session_id, int(batch_id), expires_at))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def complete(self, session_id, batch_id=None):
+        conn = self.transaction()
+        try:
+            row = conn.execute('SELECT batch_id, completed FROM leases WHERE session_id = ?', (session_id,)).fetchone()
+            if row is not None and not row[1]:
+                conn.execute('UPDATE batches SET leased = leased - 1, completed = completed + 1 WHERE batch_id = ?',
+                             (row[0],))
+                conn.execute('UPDATE leases SET completed = 1 WHERE session_id = ?', (session_id,))
+                counted = True
+            elif row is None and batch_id is not None:
+                # The lease expired before the participant finished; the batch was still done
+                counted = conn.execute('UPDATE batches SET completed = completed + 1 WHERE batch_id = ?',
+                                       (int(batch_id),)).rowcount > 0
+                if counted:
+                    conn.execute('INSERT INTO leases (session_id, batch_id, expires_at, completed) VALUES (?, ?, ?, 1)',
+                                 (session_id, int(batch_id), time.time()))
+            else:
+                counted = False
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return counted
+
+    def counts(self):
+        conn = self.transaction()
+        try:
+            self._expire(conn, time.time())
+            rows = conn.execute('SELECT batch_id, completed + leased FROM batches ORDER BY batch_id').fetchall()
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return {str(batch_id): count for batch_id, count in rows}
+
+class MemoryBatchAllocator(BatchAllocator):
+    def __init__(self, lease_seconds=LEASE_SECONDS):
+        super().__init__(lease_seconds)
+        self.batches = {}  # batch_id -> [completed, leased]
+        self.leases = {}  # session_id -> [batch_id, expires_at, completed]
+        self.lock = threading.Lock()
+
+    def seed(self, batch_counts):
+        with self.lock:
+            for batch_id, count in batch_counts.items():
+                self.batches.setdefault(int(batch_id), [count, 0])
+
+    def _expire(self, now):
+        for session_id, (batch_id, expires_at, completed) in list(self.leases.items()):
+            if not completed and expires_at < now:
+                self.batches[batch_id][1] -= 1
+                del self.leases[session_id]
+
+    def assign(self, session_id):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            lease = self.leases.get(session_id)
+            if lease is not None and not lease[2]:
+                batch_id = lease[0]
+            else:
+                if not self.batches:
+                    raise ValueError("No batches available for assignment")
+                batch_id = min(self.batches, key=lambda b: (sum(self.batches[b]), b))
+                self.batches[batch_id][1] += 1
+            self.leases[session_id] = [batch_id, now + self.lease_seconds, False]
+            return batch_id
+
+    def renew(self, session_id, batch_id=None):
+        with self.lock:
+            lease = self.leases.get(session_id)
+            if lease is None and batch_id is not None and int(batch_id) in self.batches:
+                self.batches[int(batch_id)][1] += 1
+                self.leases[session_id] = [int(batch_id), time.time() + self.lease_seconds, False]
+            elif lease is not None and not lease[2]:
+                lease[1] = time.time() + self.lease_seconds
+
+    def complete(self, session_id, batch_id=None):
+        with self.lock:
+            lease = self.leases.get(session_id)
+            if lease is None:
+                if batch_id is None or int(batch_id) not in self.batches:
+                    return False
+                self.batches[int(batch_id)][0] += 1
+                self.leases[session_id] = [int(batch_id), time.time(), True]
+                return True
+            if lease[2]:
+                return False
+            lease[2] = True
+            self.batches[lease[0]][0] += 1
+            self.batches[lease[0]][1] -= 1
+            return True
+
+    def counts(self):
+        with self.lock:
+            self._expire(time.time())
+            return {str(batch_id): sum(state) for batch_id, state in sorted(self.batches.items())}
+
+class ProgressStore:
+    """Completed GPT tasks of one output file, as task ID -> size of the output file right after
+    the task's row. CheckpointJournal validates these entries against the output file on open."""
+    def load(self):
+        raise NotImplementedError
+
+    def record(self, task_id, offset):
+        """Add one entry; it is durable after the next sync()"""
+        raise NotImplementedError
+
+    def replace(self, entries):
+        """Replace all entries, e.g. after recovery rebuilt them from the output file"""
+        raise NotImplementedError
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.sync()
+
+class SQLiteProgressStore(ProgressStore):
+    """Entries are buffered and written in one transaction per sync(), so a run costs one commit per fsync interval"""
+    def __init__(self, db, output_file):
+        self.db = db
+        self.output = os.path.abspath(output_file)
+        self.pending = []
+        self.db.connect().execute(
+            'CREATE TABLE IF NOT EXISTS gpt_progress ('
+            ' output TEXT NOT NULL, task_id TEXT NOT NULL, offset INTEGER NOT NULL, PRIMARY KEY (output, task_id))'
+        )
+
+    def load(self):
+        rows = self.db.connect().execute(
+            'SELECT task_id, offset FROM gpt_progress WHERE output = ?', (self.output,)
+        ).fetchall()
+        # IDs are stored as JSON so integer and string IDs come back as they went in
+        return {json.loads(task_id): offset for task_id, offset in rows}
+
+    def record(self, task_id, offset):
+        self.pending.append((self.output, json.dumps(task_id), offset))
+
+    def replace(self, entries):
+        self.pending = []
+        conn = self.db.transaction()
+        try:
+            conn.execute('DELETE FROM gpt_progress WHERE output = ?', (self.output,))
+            conn.executemany('INSERT INTO gpt_progress (output, task_id, offset) VALUES (?, ?, ?)',
+                             [(self.output, json.dumps(task_id), offset) for task_id, offset in entries.items()])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def sync(self):
+        if not self.pending:
+            return
+        conn = self.db.transaction()
+        try:
+            conn.executemany('INSERT OR REPLACE INTO gpt_progress (output, task_id, offset) VALUES (?, ?, ?)',
+                             self.pending)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.pending = []
+
+class MemoryProgressStore(ProgressStore):
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else {}
+
+    def load(self):
+        return dict(self.entries)
+
+    def record(self, task_id, offset):
+        self.entries[task_id] = offset
+
+    def replace(self, entries):
+        self.entries.clear()
+        self.entries.update(entries)
+
+class SQLiteStorage:
+    def __init__(self, path=STATE_DB, session_ttl=SESSION_TTL, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.db = SQLiteDatabase(path)
+        self.sessions = SQLiteSessionStore(self.db, session_ttl)
+        self.batches = SQLiteBatchAllocator(self.db, lease_seconds)
+        conn = self.db.connect()
+        create_annotations_table(conn)
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def annotation_sink(self, **kwargs):
+        return SQLiteAnnotationSink(self.db, **kwargs)
+
+    def progress(self, output_file):
+        return SQLiteProgressStore(self.db, output_file)
+
+    def get_meta(self, key, default=None):
+        row = self.db.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.db.connect().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def import_annotations(self, records, source, offset):
+        """Insert migrated annotations and advance the source's import watermark in one transaction"""
+        conn = self.db.transaction()
+        try:
+            insert_annotations(conn, records)
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (f'import:{source}', json.dumps(offset)))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+class MemoryStorage:
+    def __init__(self, session_ttl=SESSION_TTL, lease_seconds=LEASE_SECONDS):
+        self.path = MEMORY
+        self.sessions = MemorySessionStore(session_ttl)
+        self.batches = MemoryBatchAllocator(lease_seconds)
+        self.annotations = []  # Shared by every sink of this storage
+        self.progress_entries = {}  # output file -> entries
+        self.meta = {}
+        self.lock = threading.Lock()
+
+    def annotation_sink(self, **kwargs):
+        return MemoryAnnotationSink(self.annotations, **kwargs)
+
+    def progress(self, output_file):
+        return MemoryProgressStore(self.progress_entries.setdefault(os.path.abspath(output_file), {}))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            return json.loads(self.meta[key]) if key in self.meta else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.meta[key] = json.dumps(value)
+
+    def import_annotations(self, records, source, offset):
+        with self.lock:
+            self.annotations.extend(json.loads(json.dumps(record)) for record in records)
+            self.meta[f'import:{source}'] = json.dumps(offset)
+
+def open_storage(spec=STATE_DB, **kwargs):
+    """SQLite storage at the path `spec`, or in-process storage for 'memory'"""
+    if spec == MEMORY:
+        return MemoryStorage(**kwargs)
+    return SQLiteStorage(spec, **kwargs)
+
+def migrate_batch_counts(storage, path):
+    """Seed the allocator from a batch_count.json file; batches it already knows keep their counts"""
+    batch_counts, snapshot_id = read_batch_counts(path)
+    if snapshot_id:
+        current = storage.get_meta(SNAPSHOT_META_KEY)
+        if current not in (None, snapshot_id):
+            raise ValueError(f"Error: {path} counts batches of dataset snapshot {snapshot_id}, "
+                             f"but {storage.path} holds snapshot {current}.")
+        storage.set_meta(SNAPSHOT_META_KEY, snapshot_id)
+    storage.batches.seed(batch_counts)
+    return len(batch_counts)
+
+def migrate_responses(storage, directory):
+    """Import the complete rows of every response JSONL file past its import watermark; safe to re-run"""
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(directory, '*.jsonl'))):
+        source = os.path.abspath(path)
+        offset = start = storage.get_meta(f'import:{source}', 0)
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            records = []
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # A row still being written is picked up by the next run
+                offset += len(line)
+                if line.strip():
+                    records.append(json.loads(line))
+                if len(records) >= IMPORT_BATCH:
+                    storage.import_annotations(records, source, offset)
+                    imported += len(records)
+                    records = []
+            if records or offset != start:
+                storage.import_annotations(records, source, offset)
+                imported += len(records)
+    return imported
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the shared state database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate = subparsers.add_parser('migrate', help='Import state kept in files by earlier versions')
+    migrate.add_argument('--db', default=STATE_DB, help='State database to import into')
+    migrate.add_argument('--batch-counts', default=None, help='batch_count.json to seed the batch allocator from')
+    migrate.add_argument('--responses', default=None, help='Directory of response JSONL files to copy into the annotations table')
+    args = parser.parse_args()
+
+    storage = open_storage(args.db)
+    if args.batch_counts:
+        print(f"Seeded {migrate_batch_counts(storage, args.batch_counts)} batches from {args.batch_counts}")
+    if args.responses:
+        print(f"Imported {migrate_responses(storage, args.responses)} annotations from {args.responses}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope='session')
+def pga(tmp_path_factory):
+    """process_gpt_answers, imported with a throwaway Azure OpenAI config unless the repo has its own"""
+    pytest.importorskip('openai')
+    home = tmp_path_factory.mktemp('home')
+    (home / 'azure_openai').mkdir()
+    (home / 'azure_openai' / 'config.ini').write_text(
+        '[mock]\napi_base = http://localhost\napi_key = x\napi_version = 2024-01-01\nengine = mock-deployment\n')
+    previous_home = os.environ.get('HOME')
+    os.environ['HOME'] = str(home)
+    try:
+        return importlib.import_module('process_gpt_answers')
+    finally:
+        if previous_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = previous_home
@@ -0,0 +1,87 @@
+"""DeploymentPool: how requests are spread over labels and paced per deployment.
+
+    python -m pytest tests
+"""
+import configparser
+import time
+from collections import Counter
+
+class MockInterface:
+    """Config labels without clients; `sections` holds extra config options per label"""
+    def __init__(self, labels, **sections):
+        self.config_labels = labels
+        self.config = configparser.ConfigParser()
+        for label in labels:
+            self.config[label] = sections.get(label, {})
+
+    def get_client(self, label):
+        return None, f'{label}-deployment'
+
+def test_sequential_requests_take_turns_across_labels(pga):
+    latencies = {'east': 0.50, 'west': 0.52, 'north': 0.55}
+    pool = pga.DeploymentPool(MockInterface(list(latencies)))
+    used = Counter()
+    for _ in range(300):
+        deployment = pool.acquire()
+        used[deployment.label] += 1
+        pool.release(deployment, latency=latencies[deployment.label])
+    assert used == {'east': 100, 'west': 100, 'north': 100}
+
+def test_each_deployment_has_its_own_rate(pga):
+    def run(labels, requests=20):
+        pool = pga.DeploymentPool(MockInterface(labels), rate=20)
+        start = time.monotonic()
+        used = Counter()
+        for _ in range(requests):
+            deployment = pool.acquire()
+            used[deployment.label] += 1
+            pool.release(deployment, latency=0.0)
+        return time.monotonic() - start, used
+
+    single, _ = run(['east'])
+    double, used = run(['east', 'west'])
+    assert single > 0.85  # 19 requests after the first token at 20/s
+    assert double < 0.7 and used == {'east': 10, 'west': 10}
+
+def test_label_rate_from_config_weights_the_split(pga):
+    interface = MockInterface(['east', 'west'], west={'rate': '40'})
+    pool = pga.DeploymentPool(interface, rate=10)
+    used = Counter()
+    deadline = time.monotonic() + 1.0
+    while time.monotonic() < deadline:
+        deployment = pool.acquire()
+        used[deployment.label] += 1
+        pool.release(deployment, latency=0.0)
+    assert used['west'] > 2.5 * used['east']
+
+def throttle(pool, **hints):
+    deployment = pool.acquire()
+    pool.release(deployment, status_code=429, **hints)
+    return deployment
+
+def timed_acquire(pool):
+    start = time.monotonic()
+    deployment = pool.acquire()
+    pool.release(deployment, latency=0.0)
+    return deployment, time.monotonic() - start
+
+def test_cooldown_follows_the_retry_after_hint(pga):
+    pool = pga.DeploymentPool(MockInterface(['east']))
+    throttle(pool, retry_after=0.2)
+    _, waited = timed_acquire(pool)
+    assert 0.15 < waited < 1.0
+
+def test_last_deployment_cools_down_no_longer_than_the_backoff(pga):
+    pool = pga.DeploymentPool(MockInterface(['east']))
+    throttle(pool, backoff=0.2)
+    _, waited = timed_acquire(pool)
+    assert 0.15 < waited < 1.0
+
+def test_throttled_deployment_leaves_rotation_while_others_serve(pga):
+    pool = pga.DeploymentPool(MockInterface(['east', 'west']))
+    throttled = throttle(pool, backoff=0.2)
+    for _ in range(5):
+        deployment, waited = timed_acquire(pool)
+        assert deployment is not throttled and waited < 0.1
+    # Without a hint it sits out the pool's full cooldown, since other deployments can serve
+    assert throttled.cooldown_until - time.monotonic() > pool.cooldown - 1
@@ -0,0 +1,128 @@
+"""generate_gpt_answer against a mock chat client: retries, dead letters, usage and the run log.
+
+    python -m pytest tests
+"""
+import configparser
+import json
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('openai')
+
+from run_telemetry import RunTelemetry, MIN_RATE_SECONDS  # noqa: E402
+
+TASK = {'ID': 7, 'user_query': 'A moonlit poster', 'design_choices': {}, 'images': []}
+ANSWER = {'background_color': {'suggestion': 'navy', 'confidence': 'high'}, 'overall_confidence': 'high'}
+USAGE = {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120}
+
+class APIError(Exception):
+    """Stands in for the openai errors; the retry policy only looks at these attributes"""
+    def __init__(self, message, status_code, code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.response = types.SimpleNamespace(headers=headers or {})
+
+def completion(content, usage=USAGE):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)],
+                                 usage=types.SimpleNamespace(**usage) if usage else None)
+
+class MockClient:
+    """Chat client answering each call with the next scripted completion or raising the next scripted error"""
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, model, messages, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class MockInterface:
+    config_labels = ['mock']
+
+    def __init__(self, client):
+        self.client = client
+        self.config = configparser.ConfigParser()
+        self.config['mock'] = {}
+
+    def get_client(self, label):
+        return self.client, 'mock-deployment'
+
+@pytest.fixture
+def run(pga, tmp_path, monkeypatch):
+    """Calls generate_gpt_answer once with a mock client and returns (answer, client, pool, events)"""
+    monkeypatch.chdir(tmp_path)
+
+    def run(*outcomes):
+        client = MockClient(*outcomes)
+        pool = pga.DeploymentPool(MockInterface(client), cooldown=0)
+        telemetry = RunTelemetry('run_log.jsonl', total=1)
+        answer = pga.generate_gpt_answer(pool, dict(TASK), max_retries=3,
+                                         retry_policy=pga.RetryPolicy(base_delay=0), telemetry=telemetry)
+        telemetry.close()
+        with open('run_log.jsonl') as file:
+            events = [json.loads(line) for line in file]
+        return answer, client, pool, events
+    return run
+
+def dead_letters():
+    with open('gpt_dead_letter.jsonl') as file:
+        return [json.loads(line) for line in file]
+
+def test_usage_and_run_log_events(run):
+    answer, client, _, events = run(completion(json.dumps(ANSWER)))
+    assert answer == ANSWER
+    assert [event['event'] for event in events] == ['run_start', 'call', 'task', 'run_end']
+    assert len({event['run_id'] for event in events}) == 1
+    call, task, end = events[1:]
+    assert call['deployment'] == 'mock' and call['engine'] == 'mock-deployment' and call['attempt'] == 1
+    assert call['status'] == 200 and call['error'] is None and call['total_tokens'] == 120
+    assert task['ID'] == TASK['ID'] and task['outcome'] == 'ok' and task['attempts'] == 1
+    assert end['tokens'] == USAGE and end['calls'] == 1 and end['retries'] == 0
+    assert end['deployments'][0]['total_tokens'] == 120
+
+def test_rate_limited_call_is_retried(run):
+    throttled = APIError('slow down', 429, headers={'retry-after': '0'})
+    answer, client, pool, events = run(throttled, completion(json.dumps(ANSWER)))
+    assert answer == ANSWER and client.calls == 2
+    calls = [event for event in events if event['event'] == 'call']
+    assert [(call['attempt'], call['status'], call['error']) for call in calls] == [(1, 429, 'http_429'), (2, 200, None)]
+    assert 'total_tokens' not in calls[0]
+    assert events[-2]['outcome'] == 'ok' and events[-2]['attempts'] == 2
+    assert events[-1]['retries'] == 1 and events[-1]['tokens']['total_tokens'] == 120
+    assert pool.stats()[0]['throttled'] == 1
+    assert not os.path.exists('gpt_dead_letter.jsonl')
+
+def test_content_filter_goes_to_dead_letter(run):
+    filtered = APIError('filtered', 400, code='content_filter')
+    answer, client, _, events = run(filtered)
+    assert answer is None and client.calls == 1
+    assert [(entry['ID'], entry['reason'], entry['attempts']) for entry in dead_letters()] == [(TASK['ID'], 'content_filter', 1)]
+    assert events[1]['error'] == 'content_filter' and events[1]['status'] == 400
+    assert events[2]['outcome'] == 'failed' and events[2]['attempts'] == 1
+
+def test_malformed_json_goes_to_dead_letter(run):
+    answer, client, _, events = run(completion('not json'))
+    assert answer is None and client.calls == 1
+    assert [(entry['reason'], entry['attempts']) for entry in dead_letters()] == [('malformed_json', 1)]
+    # The call itself succeeded and its tokens were spent
+    assert events[1]['status'] == 200 and events[1]['total_tokens'] == 120
+    assert events[2]['outcome'] == 'failed'
+
+def test_tokens_per_min_waits_for_enough_elapsed_time():
+    telemetry = RunTelemetry(None, total=10)
+    telemetry.record_call(1, 'mock', 'mock-deployment', 1, 0.1, 0, usage=USAGE)
+    assert telemetry.summary()['tokens_per_min'] is None
+    assert 'n/a tokens/min' in telemetry.summary_line()
+    telemetry.started -= 2 * MIN_RATE_SECONDS
+    assert telemetry.summary()['tokens_per_min'] == pytest.approx(120 * 60 / (2 * MIN_RATE_SECONDS), rel=0.01)
+    telemetry.close()
@@ -0,0 +1,135 @@
+"""Image cache and the /image route against a local fake HTTP server.
+
+    python -m pytest tests
+"""
+import contextlib
+import functools
+import http.server
+import io
+import os
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import app as annotation_app
+from image_cache import ImageCache, THUMB_WIDTHS, url_key
+from benchmarks.synthetic import write_dataset
+
+Image = pytest.importorskip('PIL.Image')
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    requests = Counter()  # path -> GET requests
+
+    def do_GET(self):
+        CountingHandler.requests[self.path] += 1
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+def png(color, size=(600, 300)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the background fetch")
+        time.sleep(0.02)
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    """Base URL of an http.server serving red.png, a byte-identical copy.png, and blue.png"""
+    root = tmp_path_factory.mktemp('images')
+    (root / 'red.png').write_bytes(png('red'))
+    (root / 'copy.png').write_bytes(png('red'))
+    (root / 'blue.png').write_bytes(png('blue'))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(CountingHandler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture(scope='module')
+def client(server, tmp_path_factory):
+    """Test client of the app over a small dataset whose images are served by `server`"""
+    work_dir = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        write_dataset('data_with_gpt.jsonl', 3)
+        urls = [f'{server}/blue.png', f'{server}/missing.png', f'{server}/red.png']
+        lines = []
+        with open('data_with_gpt.jsonl') as file:
+            for line in file:
+                lines.append(line.replace('"urls": [', f'"urls": ["{urls[0]}", "{urls[1]}", "{urls[2]}", ', 1))
+        with open('data_with_gpt.jsonl', 'w') as file:
+            file.writelines(lines)
+        with contextlib.redirect_stdout(io.StringIO()):
+            annotation_app.init_app(trial_mode=False, state_db='memory', log_level='WARNING')
+        yield annotation_app.app.test_client()
+        # Flush while the working directory still exists
+        annotation_app.annotation_sink.close()
+        annotation_app.metrics.close()
+    finally:
+        os.chdir(cwd)
+
+def test_fetch_stores_one_object_per_content_hash(server, tmp_path):
+    cache = ImageCache(str(tmp_path / 'cache'))
+    digest = cache.fetch(f'{server}/red.png')
+    assert cache.fetch(f'{server}/copy.png') == digest
+    assert cache.fetch(f'{server}/blue.png') != digest
+    objects = [name for _, _, names in os.walk(tmp_path / 'cache' / 'objects') for name in names]
+    assert len(objects) == 2
+    # Known URLs are served from the cache without another download
+    requests = CountingHandler.requests['/red.png']
+    assert cache.fetch(f'{server}/red.png') == digest
+    assert CountingHandler.requests['/red.png'] == requests
+
+    payload, mimetype = cache.thumbnail(digest, 200)
+    assert mimetype == 'image/png'
+    with Image.open(io.BytesIO(payload)) as thumb:
+        assert thumb.size == (200, 100)
+
+def test_image_route_redirects_on_a_miss_then_serves_the_thumbnail(server, client):
+    url = f'{server}/blue.png'
+    response = client.get(f'/image/{url_key(url)}?w=200')
+    assert response.status_code == 302 and response.headers['Location'] == url
+
+    wait_until(lambda: client.get(f'/image/{url_key(url)}?w=200').status_code == 200)
+    response = client.get(f'/image/{url_key(url)}?w=200')
+    assert response.mimetype == 'image/png' and response.headers['ETag']
+    assert 'immutable' in response.headers['Cache-Control']
+    with Image.open(io.BytesIO(response.data)) as thumb:
+        assert thumb.width == 200
+
+    etag = response.headers['ETag']
+    assert client.get(f'/image/{url_key(url)}?w=200', headers={'If-None-Match': etag}).status_code == 304
+
+def test_image_route_rejects_other_widths_and_unknown_images(server, client):
+    url = f'{server}/red.png'
+    assert 123 not in THUMB_WIDTHS
+    assert client.get(f'/image/{url_key(url)}?w=123').status_code == 400
+    assert client.get(f'/image/{url_key(server + "/not-in-dataset.png")}').status_code == 404
+
+def test_failed_download_is_not_retried_within_failure_ttl(server, client):
+    url = f'{server}/missing.png'
+    cache = annotation_app.image_cache
+    assert client.get(f'/image/{url_key(url)}').status_code == 302
+    wait_until(lambda: url in cache.failures)
+    assert CountingHandler.requests['/missing.png'] == 1
+
+    for _ in range(3):
+        assert client.get(f'/image/{url_key(url)}').status_code == 302
+    time.sleep(0.2)
+    assert CountingHandler.requests['/missing.png'] == 1
+
+    # Once the failure is older than FAILURE_TTL the URL is tried again
+    cache.failures[url] -= cache.failure_ttl
+    client.get(f'/image/{url_key(url)}')
+    wait_until(lambda: CountingHandler.requests['/missing.png'] == 2 and url not in cache.pending)